@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""Time essex's subcommands against generated scan directories, with stand-in s6 tools"""
+
+import json, os, platform, resource, shlex, struct, sys, tempfile, time
+from contextlib import suppress
+from statistics import median
+
+from plumbum import local, CommandNotFound
+from plumbum.cli import Application, Flag, SwitchAttr, Range
+from plumbum.colors import blue, green, red, yellow
+
+# skalibs TAI64 labels are offset by 2**62, and by TAI-UTC (37s since 2017)
+TAI64_UNIX_OFFSET = 2 ** 62 + 37
+
+# Each stand-in appends its name to $ESSEX_BENCH_CALLS, one line per fork
+FAKES = {
+    's6-svc': 'exit 0',
+    's6-svscanctl': 'exit 0',
+    's6-svscan': 'exit 0',
+    's6-log': 'exec cat >/dev/null',
+    's6-svstat': (
+        'echo true true true true false "$ESSEX_BENCH_PID" -1 NA -1 '
+        '@400000006ad45d9300000000 @400000006ad45d9300000000 60 60'
+    ),
+    'fdmove': 'shift 2; exec "$@"',
+    'lsof': 'echo "$ESSEX_BENCH_PID"',
+    'pstree': 'echo "s6-svscan---s6-supervise---sleep"',
+}
+
+# Real tools essex may fork, counted but otherwise left alone
+PASSTHROUGH = ('bat', 'highlight', 'readlink', 'tail', 'zstd')
+
+# name, essex args, and a per-repeat cleanup (relative to the scan dir), if any;
+# {svc}, {since}, {archived_since}, {archived_until}, {manifest}, and {batch} are filled in per tree
+CASES = (
+    ('list', ['list'], None),
+    ('list glob', ['list', 'svc-00*'], None),
+    ('status', ['status'], None),
+    ('status one', ['status', '{svc}'], None),
+    ('status tag', ['status', '@tier-1'], None),
+    ('status ndjson', ['status', '--format', 'ndjson'], None),
+    ('pid', ['pid'], None),
+    ('pid one', ['pid', '{svc}'], None),
+    ('tree', ['tree'], None),
+    ('print', ['print', '-n'], None),
+    ('print one', ['print', '-n', '{svc}'], None),
+    ('log one', ['log', '-n', '20', '{svc}'], None),
+    ('log', ['log', '-n', '20'], None),
+    ('log since', ['log', '-s', '{since}', '{svc}'], None),
+    ('log archived', ['log', '-s', '{archived_since}', '-u', '{archived_until}', '{svc}'], None),
+    ('log grep', ['log', '-g', 'request 7[0-9]+ done'], None),
+    ('start', ['start', '{svc}'], None),
+    ('stop', ['stop', '{svc}'], None),
+    ('reload', ['reload', '{svc}'], None),
+    ('sig', ['sig', 'hup'], None),
+    ('enable', ['enable', '{svc}'], None),
+    ('disable', ['disable', '{svc}'], None),
+    ('sync plan', ['sync', '-n'], None),
+    ('sync', ['sync'], None),
+    ('upgrade', ['upgrade'], None),
+    ('metrics', ['metrics'], None),
+    ('top', ['top', '-n', '1', '-i', '0.1'], None),
+    ('new', ['new', 'bench-new', 'sleep 1'], 'bench-new'),
+    ('apply', ['apply', '{manifest}'], None),
+    ('batch', ['batch', '{batch}'], None),
+    ('on', ['on'], None),
+    ('off', ['off'], None),
+)
+
+
+def tai64n_label(secs, nano=0):
+    return f"@{secs + TAI64_UNIX_OFFSET:016x}{nano:08x}"
+
+
+def which(name):
+    with suppress(CommandNotFound):
+        return local.which(name)
+
+
+def write_script(path, body):
+    path.write(f"#!/bin/sh\n{body}\n")
+    path.chmod(0o755)
+
+
+def make_bin(bin_dir):
+    """Fill bin_dir with stand-in s6 tools and counting wrappers for real ones"""
+    bin_dir.mkdir()
+    log_call = 'echo "${0##*/}" >>"$ESSEX_BENCH_CALLS"'
+    for name, body in FAKES.items():
+        write_script(bin_dir / name, f"{log_call}\n{body}")
+    for name in PASSTHROUGH:
+        real = which(name)
+        if real:
+            write_script(bin_dir / name, f'{log_call}\nexec {shlex.quote(str(real))} "$@"')
+
+
+def make_logs(log_dir, svc_name, now, current_kib, archives, archive_kib):
+    """
+    Write a current log file and archives of TAI64N-stamped lines, oldest first,
+    returning the middle half of the first file's stamps, and the last stamp
+    """
+    log_dir.mkdir()
+    line_count = 0
+
+    def block(kib, start):
+        nonlocal line_count
+        lines, size = [], 0
+        while size < kib * 1024:
+            line_count += 1
+            line = (
+                f"{tai64n_label(start + line_count)} {svc_name}: "
+                f"request {line_count} done in {line_count % 997}ms status=200\n"
+            )
+            lines.append(line)
+            size += len(line)
+        return ''.join(lines)
+
+    start, first_lines = now - 86400, 0
+    for _ in range(archives):
+        text = block(archive_kib, start)
+        first_lines = first_lines or line_count
+        # s6-log names archives for when they're rotated, after their last line
+        (log_dir / f"{tai64n_label(start + line_count)}.s").write(text)
+    (log_dir / 'current').write(block(current_kib, start))
+    first_lines = first_lines or line_count
+    return (
+        (start + first_lines // 4, start + first_lines * 3 // 4),
+        start + line_count
+    )
+
+
+def make_status(supervise, up, pid, now):
+    """Write an s6 >= 2.10 supervise/status file: stamps, pid, pgid, wstat, flags"""
+    supervise.mkdir()
+    stamp = now - 3600 + TAI64_UNIX_OFFSET
+    # wantedup and ready, or wantedup with a down file's normal exit
+    flags = 0b11100 if up else 0
+    data = struct.pack('>QLQLQQHB', stamp, 0, stamp, 0, pid if up else 0, pid, 0, flags)
+    (supervise / 'status').write(data, mode='wb')
+
+
+def hold_fifo(path, held):
+    """Make a control fifo and keep it open for reading, as s6-supervise does"""
+    os.mkfifo(path)
+    held.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+
+
+def make_tree(root, size, current_kib, archives, archive_kib, held):
+    """Generate a scan dir of size services and their logs, returning the placeholders' values"""
+    svcs_dir, logs_dir = root / 'svcs', root / 'svcs-logs'
+    svcs_dir.mkdir()
+    logs_dir.mkdir()
+    (svcs_dir / '.s6-svscan').mkdir()
+    hold_fifo(svcs_dir / '.s6-svscan' / 'control', held)
+    now, pid = int(time.time()), os.getpid()
+    since = now
+    for idx in range(size):
+        name = f"svc-{idx:04d}"
+        svc = svcs_dir / name
+        svc.mkdir()
+        write_script(svc / 'run', f"exec 2>&1\nexec sleep {1000 + idx}")
+        (svc / 'log').mkdir()
+        write_script(svc / 'log' / 'run', f"exec s6-log T s4194304 S41943040 {logs_dir / name}")
+        (svc / 'tags').write(f"tier-{idx % 3}\n")
+        if idx and not idx % 7:
+            (svc / 'dependencies').write(f"svc-{idx - 1:04d}\n")
+        # every 10th is disabled and down, and every 25th is enabled but down, for sync to fix
+        disabled = not idx % 10
+        if disabled:
+            (svc / 'down').touch()
+        make_status(svc / 'supervise', not (disabled or idx % 25 == 24), pid, now)
+        hold_fifo(svc / 'supervise' / 'control', held)
+        make_status(svc / 'log' / 'supervise', True, pid, now)
+        hold_fifo(svc / 'log' / 'supervise' / 'control', held)
+        archived, last = make_logs(logs_dir / name, name, now, current_kib, archives, archive_kib)
+        since = min(since, last - 100)
+    manifest = root / 'manifest.json'
+    manifest.write(json.dumps({
+        'defaults': {'enable': True},
+        'services': {
+            f"applied-{idx:04d}": {'cmd': f"sleep {2000 + idx}"}
+            for idx in range(max(1, size // 10))
+        }
+    }))
+    batch = root / 'batch.txt'
+    batch.write(''.join(
+        f"{cmd} svc-{idx:04d}\n"
+        for idx in range(1, size, max(1, size // 10)) if idx % 10 and idx % 25 != 24
+        for cmd in ('status', 'pid', 'start')
+    ))
+    return svcs_dir, logs_dir, {
+        'svc': f"svc-{max(0, size // 2 - 3):04d}",
+        'since': tai64n_label(since),
+        'archived_since': tai64n_label(archived[0]),
+        'archived_until': tai64n_label(archived[1]),
+        'manifest': str(manifest),
+        'batch': str(batch),
+    }
+
+
+class EssexBench(Application):
+    """
+    Time essex's subcommands against generated scan directories of services and logs,
+    with stand-in s6, lsof, and pstree tools on PATH, and count the processes each forks
+
+    Each case runs against a fresh essex process, timing it from the outside,
+    so results include interpreter and plumbum startup, as users see them.
+    """
+
+    PROGNAME = 'bench.py'
+    COLOR_USAGE = green
+    COLOR_GROUPS = {'Switches': blue, 'Subcommands': blue}
+
+    sizes = SwitchAttr(
+        ['s', 'sizes'],
+        argname='N,N,...',
+        help="generate scan dirs of these many services",
+        default='10,100,1000'
+    )
+
+    repeat = SwitchAttr(
+        ['r', 'repeat'],
+        Range(1, 1000),
+        argname='TIMES',
+        help="run each case this many times, reporting the median and fastest",
+        default=5
+    )
+
+    current_kib = SwitchAttr(
+        ['current-kib'],
+        Range(1, 65536),
+        argname='KIB',
+        help="size of each service's current log file",
+        default=16
+    )
+
+    archives = SwitchAttr(
+        ['archives'],
+        Range(0, 1000),
+        argname='COUNT',
+        help="number of archived log files per service",
+        default=2
+    )
+
+    archive_kib = SwitchAttr(
+        ['archive-kib'],
+        Range(1, 65536),
+        argname='KIB',
+        help="size of each archived log file",
+        default=64
+    )
+
+    cases = SwitchAttr(
+        ['c', 'cases'],
+        argname='NAME,NAME,...',
+        help=f"only run these cases, of: {', '.join(case for case, *_ in CASES)}"
+    )
+
+    essex_cmd = SwitchAttr(
+        ['e', 'essex'],
+        argname='COMMAND',
+        help=(
+            "run essex as COMMAND, split like a shell would "
+            "(default: this interpreter with essex/essex.py beside this script)"
+        )
+    )
+
+    output = SwitchAttr(
+        ['o', 'output'],
+        local.path,
+        argname='JSON_FILE',
+        help="write results here",
+        default='bench-results.json'
+    )
+
+    compare = SwitchAttr(
+        ['compare'],
+        local.path,
+        argname='JSON_FILE',
+        help="compare median times and fork counts with a previous run's results"
+    )
+
+    keep = Flag(
+        ['k', 'keep'],
+        help="keep the generated trees, printing where they are"
+    )
+
+    def essex(self):
+        if self.essex_cmd:
+            return shlex.split(self.essex_cmd)
+        return [sys.executable, str(local.path(__file__).dirname / 'essex' / 'essex.py')]
+
+    def time_case(self, essex, args, cleanup, calls):
+        """Run a case repeatedly, returning its timings, fork count, and exit code"""
+        times, forks, code = [], 0, 0
+        for _ in range(self.repeat):
+            calls.write('')
+            start = time.perf_counter()
+            code = essex[args].run(retcode=None)[0]
+            times.append(time.perf_counter() - start)
+            forks = len(calls.read().splitlines())
+            if cleanup:
+                cleanup.delete()
+        return {
+            'median': median(times), 'min': min(times), 'first': times[0],
+            'forks': forks, 'code': code
+        }
+
+    def bench_size(self, root, size, cases, held):
+        print(f"Generating {size} services", end=' ', flush=True)
+        start = time.perf_counter()
+        svcs_dir, logs_dir, fills = make_tree(
+            root, size, self.current_kib, self.archives, self.archive_kib, held
+        )
+        print(f"in {time.perf_counter() - start:.1f}s" | blue)
+        essex_argv = self.essex()
+        essex = local[essex_argv[0]][essex_argv[1:]]['-d', svcs_dir, '-l', logs_dir]
+        results = {}
+        for name, args, cleanup in cases:
+            result = self.time_case(
+                essex,
+                [arg.format(**fills) for arg in args],
+                cleanup and svcs_dir / cleanup,
+                root.dirname / 'calls'
+            )
+            results[name] = result
+            line = (
+                f"{size:>6} {name:<14} {result['median'] * 1000:>9.1f}ms "
+                f"(min {result['min'] * 1000:.1f}ms) {result['forks']:>6} forks"
+            )
+            if result['code']:
+                line += ' ' + (f"exit {result['code']}" | red)
+            print(line)
+        return results
+
+    def show_comparison(self, results):
+        with open(self.compare) as f:
+            old = json.load(f)['results']
+        print("Median time and forks, against", str(self.compare) | blue)
+        for size, cases in results.items():
+            for name, new in cases.items():
+                before = old.get(size, {}).get(name)
+                if not before:
+                    continue
+                ratio = new['median'] / before['median']
+                color = green if ratio < 0.95 else red if ratio > 1.05 else yellow
+                print(
+                    f"{size:>6} {name:<14}",
+                    f"{ratio:>6.2f}x" | color,
+                    f"{before['median'] * 1000:>9.1f}ms -> {new['median'] * 1000:.1f}ms",
+                    f"{before['forks']:>6} -> {new['forks']} forks"
+                )
+
+    def main(self):
+        sizes = [int(size) for size in self.sizes.split(',')]
+        cases = CASES
+        if self.cases:
+            wanted = self.cases.split(',')
+            unknown = set(wanted) - {name for name, *_ in CASES}
+            if unknown:
+                print("Unknown cases:", ', '.join(sorted(unknown)) | red, file=sys.stderr)
+                return 1
+            cases = [case for case in CASES if case[0] in wanted]
+        # Every service and logger holds a control fifo open
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        need = max(sizes) * 2 + 256
+        if soft < need:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(need, hard), hard))
+        work = local.path(tempfile.mkdtemp(prefix='essex-bench-'))
+        results = {}
+        try:
+            make_bin(work / 'bin')
+            with local.env(
+                PATH=f"{work / 'bin'}:{local.env['PATH']}",
+                ESSEX_BENCH_CALLS=str(work / 'calls'),
+                ESSEX_BENCH_PID=str(os.getpid()),
+                NO_COLOR='1'
+            ):
+                local.env.pop('SERVICES_PATHS', None)
+                for size in sizes:
+                    held = []
+                    try:
+                        results[str(size)] = self.bench_size(work / f"tree-{size}", size, cases, held)
+                    finally:
+                        for fd in held:
+                            os.close(fd)
+        finally:
+            if self.keep:
+                print("Kept", str(work) | blue)
+            else:
+                work.delete()
+        with open(self.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'essex': self.essex(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'repeat': self.repeat,
+                    'current_kib': self.current_kib,
+                    'archives': self.archives,
+                    'archive_kib': self.archive_kib,
+                    'passthrough': [name for name in PASSTHROUGH if which(name)],
+                },
+                'results': results
+            }, f, indent=2)
+        print("Wrote", str(self.output) | blue)
+        if self.compare:
+            self.show_comparison(results)
+
+
+if __name__ == '__main__':
+    EssexBench.run()
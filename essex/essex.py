@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
-import re, sys
-from contextlib import suppress
-from hashlib import md5
+import io, math, os, re, signal, stat, struct, sys, time
+from contextlib import contextmanager, suppress
+from importlib import import_module
+from itertools import islice
 
 from plumbum import local, CommandNotFound, ProcessExecutionError
 from plumbum.cli import Application, Flag, SwitchAttr, Range, Set
 from plumbum.colors import blue, magenta, green, red, yellow
-from plumbum.cmd import (
-    s6_log, s6_svc, s6_svscan, s6_svscanctl, s6_svstat,
-    fdmove, lsof, pstree, tail, getent, readlink, id as uid
-)
+
+# Slower imports (asyncio, concurrent.futures, ctypes, datetime, hashlib, json, mmap,
+# and the decompressors) are deferred to where they're used,
+# so each subcommand only pays for what it needs.
 
 # TO DO / CONSIDER:
 # .s6-svscan/crash?
@@ -27,6 +28,249 @@ def fail(r, out='', err=''):
     sys.exit(r)
 
 
+class Commands:
+    """External commands, each looked up in PATH on first use rather than at startup"""
+
+    def __getattr__(self, name):
+        command = local[name.replace('_', '-')]
+        setattr(self, name, command)
+        return command
+
+
+cmds = Commands()
+
+
+class EssexError(Exception):
+    """A per-service failure, raised where fail would be called, so it can be collected"""
+
+    def __init__(self, r, out='', err=''):
+        super().__init__('\n'.join(filter(None, (out, err))).strip() or f"failed with exit code {r}")
+        self.r = r
+
+
+class Tracer:
+    """Spans for each external command run through plumbum, and each service's phases, as Chrome trace events"""
+
+    active = None
+
+    def __init__(self):
+        import threading
+        self.lock, self.get_tid = threading.Lock(), threading.get_ident
+        self.started = time.perf_counter()
+        self.events = []
+        self.forks = 0
+        self.svc_spans = {}  # svc name: [first phase's start, last phase's end, phase names]
+        self.unwaited = {}  # proc: (span name, start, argv), until it's waited for
+
+    def now(self):
+        return (time.perf_counter() - self.started) * 1e6
+
+    def add(self, name, category, start, args, svc_name=None):
+        end = self.now()
+        with self.lock:
+            self.events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': end - start,
+                'pid': os.getpid(), 'tid': self.get_tid(), 'args': args
+            })
+            if svc_name:
+                span = self.svc_spans.setdefault(svc_name, [start, end, []])
+                span[0], span[1] = min(span[0], start), max(span[1], end)
+                if category not in span[2]:
+                    span[2].append(category)
+
+    def traced_popen(self, machine, executable, argv, *args, **kwargs):
+        start = self.now()
+        proc = self.popen(machine, executable, argv, *args, **kwargs)
+        popen = getattr(proc, '_proc', proc)  # the subprocess.Popen plumbum wraps
+        name = os.path.basename(str(executable))
+        with self.lock:
+            self.forks += 1
+            self.unwaited[popen] = (name, start, [str(arg) for arg in argv])
+        wait = popen.wait
+
+        def traced_wait(*args, **kwargs):
+            code = wait(*args, **kwargs)
+            with self.lock:
+                span = self.unwaited.pop(popen, None)
+            if span:
+                self.add(span[0], 'command', span[1], {'argv': span[2], 'exitcode': code})
+            return code
+
+        popen.wait = traced_wait
+        return proc
+
+    def __enter__(self):
+        # LocalMachine has slots, so its class is patched, rather than local itself
+        machine = type(local)
+        self.outer, self.popen = Tracer.active, machine._popen
+        Tracer.active = self
+        machine._popen = lambda *args, **kwargs: self.traced_popen(*args, **kwargs)
+        return self
+
+    def __exit__(self, *exc):
+        type(local)._popen = self.popen
+        Tracer.active = self.outer
+        for popen, (name, start, argv) in list(self.unwaited.items()):
+            self.add(name, 'command', start, {'argv': argv, 'exitcode': popen.poll()})
+
+    def write(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': [
+                    {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': 'essex'}},
+                    *sorted(self.events, key=lambda event: event['ts'])
+                ],
+                'displayTimeUnit': 'ms'
+            }, f)
+
+    def summarize(self, path, top=10):
+        """Print the fork count, time spent per command, and the slowest services, to stderr"""
+        commands = {}  # command name: (runs, seconds)
+        for event in self.events:
+            if event['cat'] == 'command':
+                runs, secs = commands.get(event['name'], (0, 0))
+                commands[event['name']] = (runs + 1, secs + event['dur'] / 1e6)
+        print(
+            f"Traced {self.forks} forks in {self.now() / 1e6:.3f}s to {path}" | blue,
+            *(
+                f"  {name:<16} {runs:>5}x {secs:>9.3f}s"
+                for name, (runs, secs) in sorted(commands.items(), key=lambda item: -item[1][1])
+            ),
+            sep='\n', file=sys.stderr
+        )
+        slowest = sorted(self.svc_spans.items(), key=lambda item: item[1][0] - item[1][1])[:top]
+        if slowest:
+            width = max(len(name) for name, span in slowest)
+            print(
+                "Slowest services:" | blue,
+                *(
+                    f"  {name:<{width}} {(end - start) / 1e6:>9.3f}s  {', '.join(phases)}"
+                    for name, (start, end, phases) in slowest
+                ),
+                sep='\n', file=sys.stderr
+            )
+
+
+@contextmanager
+def phase(name, svc):
+    """Record a span of svc's phase (stop, start, ...), when tracing"""
+    tracer = Tracer.active
+    if not tracer:
+        yield
+        return
+    svc_name = f"{svc.up().name}/log" if svc.name == 'log' else svc.name
+    start = tracer.now()
+    try:
+        yield
+    finally:
+        tracer.add(f"{name} {svc_name}", name, start, {'svc': str(svc)}, svc_name)
+
+
+SVSTAT_COLS = (
+    'up', 'wantedup', 'normallyup', 'ready', 'paused', 'pid',
+    'exitcode', 'signal', 'signum', 'updownsince', 'readysince',
+    'updownfor', 'readyfor'
+)
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+ALL_ROOTS_SUBCOMMANDS = ('list', 'log', 'off', 'status', 'sync')
+
+# skalibs TAI64 labels are offset by 2**62, and by TAI-UTC (37s since 2017)
+TAI64_UNIX_OFFSET = 2 ** 62 + 37
+
+
+def tai64n_label(secs, nano):
+    return f"@{secs:016x}{nano:08x}"
+
+
+def tai64n_to_unix(label):
+    return int(label[1:17], 16) - TAI64_UNIX_OFFSET + int(label[17:25], 16) / 1e9
+
+
+def signal_name(signum):
+    with suppress(ValueError):
+        return signal.Signals(signum).name
+    return f"SIG{signum}"
+
+
+def decode_svstatus(data, svc):
+    """Decode a supervise/status file into s6-svstat's columns, or None if the format is unknown"""
+    if len(data) == 43:  # s6 >= 2.10: pid, pgid, wstat, flags
+        pid, wstat, flags = struct.unpack('>Q8xHB', data[24:])
+        wantedup = bool(flags & 0b10100)
+    elif len(data) == 35:  # s6 < 2.10: pid, wstat, flags
+        pid, wstat, flags = struct.unpack('>QHB', data[24:])
+        wantedup = bool(flags & 0b100)
+    else:
+        return None
+    stamp, stamp_nano, ready_stamp, ready_nano = struct.unpack('>QLQL', data[:24])
+    paused, finishing, ready = (bool(flags & bit) for bit in (0b1, 0b10, 0b1000))
+    up = bool(pid) and not finishing
+    signum = os.WTERMSIG(wstat) if not up and os.WIFSIGNALED(wstat) else -1
+    now = time.time()
+    return {
+        'up': up,
+        'wantedup': wantedup,
+        'normallyup': not (svc / 'down').exists(),
+        'ready': up and ready,
+        'paused': paused,
+        'pid': pid if up else -1,
+        'exitcode': os.WEXITSTATUS(wstat) if not up and os.WIFEXITED(wstat) else -1,
+        'signal': signal_name(signum) if signum > 0 else 'NA',
+        'signum': signum,
+        'updownsince': tai64n_label(stamp, stamp_nano),
+        'readysince': tai64n_label(ready_stamp, ready_nano),
+        'updownfor': int(now - (stamp - TAI64_UNIX_OFFSET + stamp_nano / 1e9)),
+        'readyfor': int(now - (ready_stamp - TAI64_UNIX_OFFSET + ready_nano / 1e9))
+    }
+
+
+def svstat(svc):
+    """Return a service's s6-svstat columns with proper types, without forking if possible"""
+    supervise = svc / 'supervise'
+    with suppress(OSError):
+        # s6-supervise keeps the control fifo open for reading while it lives
+        os.close(os.open(supervise / 'control', os.O_WRONLY | os.O_NONBLOCK))
+        with open(supervise / 'status', 'rb') as status:
+            stats = decode_svstatus(status.read(), svc)
+        if stats:
+            return stats
+    stats = {}
+    for col, val in zip(SVSTAT_COLS, cmds.s6_svstat('-o', ','.join(SVSTAT_COLS), svc).split()):
+        if val in ('true', 'false'):
+            val = val == 'true'
+        elif col not in ('signal', 'updownsince', 'readysince'):
+            val = int(val)
+        stats[col] = val
+    return stats
+
+
+class StatusCache:
+    """Services' svstat columns, only decoded again when their supervise/status files change"""
+
+    def __init__(self):
+        self.entries = {}  # svc: (supervise/status mtime, stats)
+        self.restarts = {}  # svc: times seen coming up again
+
+    def get(self, svc):
+        """svc's stats, raising OSError if it has never been supervised"""
+        mtime = os.stat(svc / 'supervise' / 'status').st_mtime_ns
+        cached = self.entries.get(svc)
+        if not cached or cached[0] != mtime:
+            stats = svstat(svc)
+            if cached and stats['up'] and stats['updownsince'] != cached[1]['updownsince']:
+                self.restarts[svc] = self.restarts.get(svc, 0) + 1
+            self.entries[svc] = cached = (mtime, stats)
+        stats = dict(cached[1])
+        now = time.time()
+        stats['updownfor'] = int(now - tai64n_to_unix(stats['updownsince']))
+        stats['readyfor'] = int(now - tai64n_to_unix(stats['readysince']))
+        stats['normallyup'] = not (svc / 'down').exists()
+        return stats
+
+
 class ColorApp(Application):
     PROGNAME = green
     VERSION = '2.0.2' | blue
@@ -40,7 +284,11 @@ class ColorApp(Application):
 
 
 class Essex(ColorApp):
-    """Simply manage services"""
+    """Simply manage services
+
+    Wherever services may be named, a glob like 'web-*' also selects each matching service,
+    and '@TAG' each service whose tags file lists TAG.
+    """
 
     SUBCOMMAND_HELPMSG = False
     DEFAULT_PATHS = ('./svcs', '~/svcs', '/var/svcs', '/svcs')
@@ -66,12 +314,51 @@ class Essex(ColorApp):
         )
     )
 
+    enabled_only = Flag(
+        ['E', 'enabled'],
+        help="only act on enabled services (configured to be running), wherever services are selected"
+    )
+
+    all_roots = Flag(
+        ['A', 'all-roots'],
+        help=(
+            "act on every existing folder from SERVICES_PATHS (or the defaults) at once, "
+            "with each line of output tagged by folder; "
+            f"only for {', '.join(ALL_ROOTS_SUBCOMMANDS)}"
+        ),
+        excludes=['directory', 'logs-directory']
+    )
+
+    trace_file = SwitchAttr(
+        ['trace'],
+        local.path,
+        argname='TRACE_FILE',
+        help=(
+            "record each external command run (argv, wall time, exit code) "
+            "and each service's phases as Chrome trace-event JSON, for chrome://tracing or Perfetto, "
+            "then summarize the fork count and slowest services"
+        ),
+        excludes=['all-roots']
+    )
+
+    # Kept warm across commands by essex serve and essex batch
+    registry = {}  # svcs_dir: {'mtime': ..., 'names': [...], 'svcs': (...)}
+    status_cache = None
+    # Set in each --all-roots child, where a selector needn't match in every root
+    one_of_roots = False
+    # Set in essex serve, whose children would inherit its environment rather than the caller's
+    serving = False
+
     def main(self):
+        try:
+            svcs_paths = local.env['SERVICES_PATHS'].split(':')
+        except KeyError:
+            svcs_paths = self.DEFAULT_PATHS
+        if self.all_roots:
+            return self.across_roots(
+                [folder for folder in map(local.path, svcs_paths) if folder.is_dir()]
+            )
         if not self.svcs_dir:
-            try:
-                svcs_paths = local.env['SERVICES_PATHS'].split(':')
-            except KeyError:
-                svcs_paths = self.DEFAULT_PATHS
             for folder in map(local.path, svcs_paths):
                 if folder.is_dir():
                     self.svcs_dir = folder
@@ -80,32 +367,907 @@ class Essex(ColorApp):
                 self.svcs_dir = local.path(svcs_paths[0])
         self.svcs_dir.mkdir()
         self.logs_dir = self.logs_dir or self.svcs_dir.up() / 'svcs-logs'
-        self.svcs = tuple(f for f in self.svcs_dir if 'run' in f)
+        if self.trace_file and self.nested_command:
+            return self.traced(self.trace_file)
+
+    def traced(self, trace_file):
+        """Run the subcommand here rather than after main, recording its trace to trace_file"""
+        subapp, argv = self.nested_command
+        self.nested_command = None
+        subapp.parent = self
+        tracer = Tracer()
+        try:
+            with tracer:
+                return subapp.run(argv, exit=False)[1]
+        finally:
+            tracer.write(trace_file)
+            tracer.summarize(trace_file)
+
+    def across_roots(self, roots):
+        """Run the subcommand in a forked child per root, merging their output as it comes, tagged by root"""
+        import json, selectors
+        subapp, argv = self.nested_command or (None, ())
+        name = ALL_ROOTS_APPS.get(subapp)
+        if not name:
+            fail(1, f"--all-roots only works with {', '.join(ALL_ROOTS_SUBCOMMANDS)}")
+        self.nested_command = None  # it's run per root here instead
+        roots = list({os.path.realpath(root): root for root in roots}.values())
+        if not roots:
+            fail(1, "No services folders found")
+        args = [name, *argv[1:]]
+        records = output_format(args[1:])
+        if records == 'json':  # merged from each root's NDJSON, then
+            idx = format_index(args[1:]) + 1
+            args[idx] = args[idx][:-len('json')] + 'ndjson'
+        if self.enabled_only:
+            args.insert(0, '--enabled')
+        width = max(len(str(root)) for root in roots)
+        Essex.one_of_roots = True
+        sel, partial, children, emitted = selectors.DefaultSelector(), {}, [], 0
+        for root in roots:
+            pid, out, err = fork_essex(args, root, root.up() / 'svcs-logs')
+            children.append(pid)
+            sel.register(out, selectors.EVENT_READ, (root, sys.stdout))
+            sel.register(err, selectors.EVENT_READ, (root, sys.stderr))
+        with suppress(KeyboardInterrupt):
+            while sel.get_map():
+                for key, events in sel.select():
+                    data = os.read(key.fd, 64 * 1024)
+                    *lines, partial[key.fd] = (partial.get(key.fd, b'') + data).split(b'\n')
+                    if not data:
+                        sel.unregister(key.fd)
+                        os.close(key.fd)
+                        lines.append(partial.pop(key.fd))
+                    root, stream = key.data
+                    for line in filter(None, lines):
+                        line = line.decode(errors='replace')
+                        if records != 'text' and stream is sys.stdout:
+                            with suppress(ValueError, TypeError):
+                                line = json.dumps({'root': str(root), **json.loads(line)})
+                            if records == 'json':
+                                line = f"{',' if emitted else '['}{line}"
+                            emitted += 1
+                            print(line, file=stream)
+                        else:
+                            print(f"{root!s:<{width}}" | magenta, line, file=stream)
+                    stream.flush()
+        if records == 'json':
+            print(']' if emitted else '[]')
+        codes = []
+        for pid in children:
+            status = os.waitpid(pid, 0)[1]
+            codes.append(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+        return max(codes)
+
+    def listing(self):
+        """svcs_dir's registry entry, with its folders' names listed again only if its mtime changed"""
+        mtime = os.stat(self.svcs_dir).st_mtime_ns
+        entry = self.registry.get(self.svcs_dir)
+        if not entry or entry['mtime'] != mtime:
+            with os.scandir(self.svcs_dir) as entries:
+                names = sorted(
+                    e.name for e in entries if not e.name.startswith('.') and e.is_dir()
+                )
+            entry = self.registry[self.svcs_dir] = {'mtime': mtime, 'names': names}
+        return entry
+
+    @property
+    def svcs(self):
+        """All services: folders with a run file, each checked once per listing"""
+        entry = self.listing()
+        if 'svcs' not in entry:
+            entry['svcs'] = tuple(
+                svc for svc in (self.svcs_dir / name for name in entry['names']) if 'run' in svc
+            )
+        return entry['svcs']
+
+    def select(self, selectors=()):
+        """Services picked by name, glob (web-*), or @tag (from their tags files), or else all of them"""
+        if not selectors:
+            svcs = self.svcs
+        else:
+            from fnmatch import fnmatchcase
+            svcs = []
+            for selector in selectors:
+                if selector.startswith('@'):
+                    found = [svc for svc in self.svcs if selector[1:] in svc_tags(svc)]
+                elif GLOB_CHARS.search(selector):
+                    found = [
+                        svc for svc in (
+                            self.svcs_dir / name for name in self.listing()['names']
+                            if fnmatchcase(name, selector)
+                        ) if 'run' in svc
+                    ]
+                elif self.one_of_roots:
+                    found = [svc for svc in (self.svcs_dir / selector,) if 'run' in svc]
+                else:  # which may not exist, for the subcommand to complain about
+                    found = [self.svcs_dir / selector]
+                if not found and not self.one_of_roots:
+                    warn(f"No services match {selector}")
+                svcs.extend(svc for svc in found if svc not in svcs)
+        if self.enabled_only:
+            return tuple(svc for svc in svcs if 'down' not in svc)
+        return tuple(svcs)
+
+    def stats(self, svc):
+        """svc's svstat columns, from the shared StatusCache if one is being kept"""
+        with phase('status', svc):
+            if self.status_cache:
+                with suppress(OSError):
+                    return self.status_cache.get(svc)
+            return svstat(svc)
+
+    def fail_if_serving(self, what):
+        """Refuse to start anything long-lived from within essex serve"""
+        if self.serving:
+            fail(1, f"{what} must be run directly, not through essex serve")
 
     def fail_if_unsupervised(self):
-        r, out, err = s6_svscanctl[self.svcs_dir].run(retcode=None)
+        r, out, err = cmds.s6_svscanctl[self.svcs_dir].run(retcode=None)
         if r == 100:
             fail(1, f"{self.svcs_dir} not currently supervised.")
         elif r:
             fail(r, out, err)
 
-    def svc_map(self, svc_names):
-        return (self.svcs_dir / sn for sn in svc_names)
-
     @property
     def root_pid(self):
+        """PID of the s6-svscan process supervising svcs_dir, found via /proc, or else lsof"""
+        if getattr(self, '_root_pid', None):
+            return self._root_pid
+        control = self.svcs_dir / '.s6-svscan' / 'control'
+        cache = self.svcs_dir / '.s6-svscan' / 'essex-pid'
+        with suppress(OSError, ValueError):
+            pid = cache.read().strip()
+            if is_svscan_for(pid, self.svcs_dir, control):
+                self._root_pid = pid
+                return pid
+        self._root_pid = find_svscan(self.svcs_dir, control) or self.lsof_root_pid(control)
+        with suppress(OSError):
+            cache.write(self._root_pid)
+        return self._root_pid
+
+    def lsof_root_pid(self, control):
         try:
-            readlink(lsof)
+            cmds.readlink(cmds.lsof)
         except:  # real lsof
-            return lsof('-t', self.svcs_dir / '.s6-svscan' / 'control').splitlines()[0]
+            return cmds.lsof('-t', control).splitlines()[0]
         else:  # busybox lsof
             return next(filter(
                 lambda p: p.endswith('/.s6-svscan/control'),
-                lsof(self.svcs_dir / '.s6-svscan' / 'control').splitlines()
+                cmds.lsof(control).splitlines()
             )).split()[0]
 
 
-class Stopper(ColorApp):
+def is_svscan_for(pid, svcs_dir, control):
+    """Whether pid is an s6-svscan process with svcs_dir as its working directory, or holding its control fifo"""
+    proc = f"/proc/{pid}"
+    try:
+        with open(f"{proc}/comm") as comm:
+            if comm.read().strip() != 's6-svscan':
+                return False
+    except OSError:
+        return False
+    try:
+        return os.path.samestat(os.stat(f"{proc}/cwd"), os.stat(svcs_dir))
+    except PermissionError:
+        pass
+    except OSError:  # it exited mid-scan
+        return False
+    with suppress(OSError):
+        fifo = os.stat(control)
+        for fd in os.listdir(f"{proc}/fd"):
+            with suppress(OSError):
+                if os.path.samestat(os.stat(f"{proc}/fd/{fd}"), fifo):
+                    return True
+    return False
+
+
+def find_svscan(svcs_dir, control):
+    """PID of the s6-svscan process for svcs_dir, from a single pass over /proc, or None"""
+    try:
+        pids = os.listdir('/proc')
+    except OSError:
+        return None
+    for pid in pids:
+        # one process vanishing mid-scan shouldn't end it
+        with suppress(OSError):
+            if pid.isdigit() and is_svscan_for(pid, svcs_dir, control):
+                return pid
+    return None
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def parse_proc_stat(text):
+    """comm, ppid, CPU ticks, thread count, and RSS bytes, from the contents of /proc/PID/stat"""
+    comm_end = text.rindex(')')
+    fields = text[comm_end + 2:].split()
+    return {
+        'comm': text[text.index('(') + 1:comm_end],
+        'ppid': int(fields[1]),
+        'ticks': int(fields[11]) + int(fields[12]),
+        'threads': int(fields[17]),
+        'rss': int(fields[21]) * PAGE_SIZE
+    }
+
+
+def proc_table():
+    """Every process's stat fields and arguments, keyed by PID, from one pass over /proc"""
+    procs = {}
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            with suppress(OSError, ValueError, IndexError):
+                with open(f"/proc/{pid}/stat") as f:
+                    proc = parse_proc_stat(f.read())
+                with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                    proc['args'] = f.read().rstrip(b'\0').decode(errors='replace').split('\0')[1:]
+                procs[int(pid)] = proc
+    return procs
+
+
+def human_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def human_seconds(secs):
+    return f"{secs:.2f}s" if secs < 60 else f"{int(secs // 60)}m{int(secs % 60):02}s"
+
+
+class ChangeIndex:
+    """Hashes of services' definitions as launched, and stats for skipping rehashes, stored per scan directory"""
+
+    DEFINITION_FILES = ('run', 'finish', 'notification-fd', 'timeout-finish')
+    DEFINITION_DIRS = ('env',)
+
+    def __init__(self, svcs_dir):
+        import json
+        self.svcs_dir = svcs_dir
+        self.path = svcs_dir / '.essex-index'
+        try:
+            with open(self.path) as index:
+                self.units = json.load(index)
+        except (OSError, ValueError):
+            self.units = {}
+
+    def key(self, unit):
+        # a unit is a service folder, or its log folder
+        return os.path.relpath(unit, self.svcs_dir)
+
+    def definition(self, unit):
+        files = list(self.DEFINITION_FILES)
+        for folder in self.DEFINITION_DIRS:
+            with suppress(OSError):
+                files.extend(f"{folder}/{f}" for f in sorted(os.listdir(unit / folder)))
+        return files
+
+    def digest(self, unit):
+        """Hash unit's whole definition, rehashing only files whose mtime or size changed"""
+        from hashlib import md5
+        record = self.units.setdefault(self.key(unit), {})
+        old_files, files = record.get('files', {}), {}
+        for name in self.definition(unit):
+            try:
+                st = os.stat(unit / name)
+            except OSError:
+                continue
+            entry = old_files.get(name)
+            if not entry or entry[:2] != [st.st_mtime_ns, st.st_size]:
+                with open(unit / name, 'rb') as f:
+                    entry = [st.st_mtime_ns, st.st_size, md5(f.read()).hexdigest()]
+            files[name] = entry
+        record['files'] = files
+        return md5(''.join(
+            f"{name}\0{entry[2]}\0" for name, entry in sorted(files.items())
+        ).encode()).hexdigest()
+
+    def changed(self, unit, stats):
+        """Whether unit's definition changed since its current launch"""
+        digest = self.digest(unit)
+        record = self.units[self.key(unit)]
+        if record.get('launch') != stats['updownsince']:
+            # not seen since this launch, so judge by mtimes and any essex run.md5
+            files = record['files']
+            launched = tai64n_to_unix(stats['updownsince'])
+            stale = any(entry[0] / 1e9 > launched for entry in files.values())
+            with suppress(OSError, IndexError, KeyError):
+                stale |= (unit / 'run.md5').read().split()[0] != files['run'][2]
+            record['launch'] = stats['updownsince']
+            record['digest'] = None if stale else digest
+        return record['digest'] != digest
+
+    def relaunched(self, unit):
+        """Record unit's current definition as launched"""
+        record = self.units[self.key(unit)]
+        record['launch'] = svstat(unit)['updownsince']
+        record['digest'] = self.digest(unit)
+
+    def save(self):
+        import json
+        tmp = self.svcs_dir / '.essex-index.new'
+        with suppress(OSError):
+            with open(tmp, 'w') as index:
+                json.dump(self.units, index, separators=(',', ':'))
+            os.replace(tmp, self.path)
+
+
+def log_files(log_dir):
+    """A logger's archived files, oldest first, followed by current"""
+    try:
+        archives = sorted(
+            f for f in os.listdir(log_dir)
+            if f.startswith('@') and f.endswith(('.s', '.u'))
+        )
+    except OSError:
+        archives = []
+    return [log_dir / f for f in archives] + [log_dir / 'current']
+
+
+DECOMPRESSORS = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma'))
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSED_MAGIC = (ZSTD_MAGIC, *(magic for magic, module in DECOMPRESSORS))
+
+
+class PipedLog(io.BufferedReader):
+    """A decompressor's output, reaping the decompressor once closed"""
+
+    def __init__(self, proc):
+        super().__init__(proc.stdout.detach())
+        self.proc = proc
+
+    def close(self):
+        super().close()
+        self.proc.wait()
+
+
+def open_log(path):
+    """Open a log file for binary reading, decompressing archives compressed by an --on-rotate processor"""
+    f = open(path, 'rb')
+    head = f.read(6)
+    f.seek(0)
+    if head.startswith(ZSTD_MAGIC):
+        f.close()
+        return PipedLog(local['zstd']['-dcq', path].popen())
+    for magic, module in DECOMPRESSORS:
+        if head.startswith(magic):
+            return import_module(module).open(f)
+    return f
+
+
+def mappable(f):
+    """Whether an opened log is a non-empty plain file, rather than a stream of decompressed data"""
+    if not isinstance(f, io.BufferedReader):
+        return False
+    st = os.fstat(f.fileno())
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+
+def last_lines(path, n):
+    """The last n lines of a log file, without newlines, read backwards from the end of the file"""
+    import mmap
+    from collections import deque
+    with open_log(path) as f:
+        if not mappable(f):
+            return [line.rstrip(b'\n') for line in deque(f, maxlen=n)]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            lines, end = [], len(m)
+            if m[end - 1:end] == b'\n':
+                end -= 1
+            while end > 0 and len(lines) < n:
+                start = m.rfind(b'\n', 0, end) + 1
+                lines.append(m[start:end])
+                end = start - 1
+    lines.reverse()
+    return lines
+
+
+def tail_log(log_dir, n):
+    """(file, lines) pairs holding a logger's last n lines, reaching back into archives if current is short"""
+    chunks = []
+    for path in reversed(log_files(log_dir)):
+        if n <= 0:
+            break
+        with suppress(FileNotFoundError):
+            lines = last_lines(path, n)
+            chunks.append((path, lines))
+            n -= len(lines)
+    chunks.reverse()
+    return chunks
+
+
+def timestamp(text):
+    """Unix time from a TAI64N label, a local ISO 8601 date and time, or a time today"""
+    from datetime import date, datetime
+    if text.startswith('@'):
+        return tai64n_to_unix(text)
+    for fmt in (
+        '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d',
+        '%H:%M:%S', '%H:%M'
+    ):
+        with suppress(ValueError):
+            parsed = datetime.strptime(text.replace(' ', 'T'), fmt)
+            if fmt.startswith('%H'):
+                parsed = datetime.combine(date.today(), parsed.time())
+            return parsed.timestamp()
+    raise ValueError(f"Unrecognized time: {text}")
+
+
+ISO_STAMP = re.compile(rb'(\d{4}-\d\d-\d\d)[ T](\d\d:\d\d:\d\d)(\.\d+)?')
+
+
+def split_stamp(line):
+    """Unix time of a log line's leading TAI64N or ISO 8601 timestamp (or None), and the rest of the line"""
+    from datetime import datetime
+    with suppress(ValueError):
+        if line[:1] == b'@':
+            return tai64n_to_unix(line[:25].decode()), line[26:]
+        stamp = ISO_STAMP.match(line)
+        if stamp:
+            day, clock, fraction = stamp.groups()
+            return datetime.strptime(
+                f"{day.decode()} {clock.decode()}", '%Y-%m-%d %H:%M:%S'
+            ).timestamp() + float(fraction or 0), line[stamp.end():].lstrip(b' ')
+    return None, line
+
+
+def line_time(line):
+    return split_stamp(line)[0]
+
+
+def bisect_log(m, when, after=False):
+    """Offset of the first line in m stamped at (or if after, past) when, by binary search"""
+    lo, hi = 0, len(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = m.rfind(b'\n', 0, mid) + 1
+        end = m.find(b'\n', start) + 1 or len(m)
+        stamp = line_time(m[start:end])
+        if stamp is None or stamp < when or (after and stamp == when):
+            lo = end
+        else:
+            hi = start
+    return lo
+
+
+def log_range(path, since=None, until=None):
+    """Yield blocks of a log file's lines stamped between since and until, touching only those bytes"""
+    import mmap
+    with open_log(path) as f:
+        if not mappable(f):
+            for line in f:
+                stamp = line_time(line)
+                if stamp is not None and (
+                    (since is None or stamp >= since) and (until is None or stamp <= until)
+                ):
+                    yield line
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0 if since is None else bisect_log(m, since)
+            end = len(m) if until is None else bisect_log(m, until, after=True)
+            for offset in range(start, end, 8 * 1024 ** 2):
+                yield m[offset:min(offset + 8 * 1024 ** 2, end)]
+
+
+def range_files(log_dir, since=None, until=None):
+    """A logger's files which may hold lines stamped between since and until, judged by archive names"""
+    files, started = [], None
+    for path in log_files(log_dir):
+        ended = tai64n_to_unix(path.name) if path.name.startswith('@') else None
+        if (since is None or ended is None or ended >= since) and (
+            until is None or started is None or started <= until
+        ):
+            files.append(path)
+        started = ended
+    return files
+
+
+GREP_CHUNK = 4 * 1024 ** 2
+GREP_SPLIT = 32 * 1024 ** 2
+
+
+def grep_log(name, path, pattern, start=0, end=None, since=None, until=None):
+    """(name, stamp, rest of line) for each line matching pattern in a log file, or in lines starting within a byte range of a plain one"""
+    regex, matches, rest = re.compile(pattern.encode()), [], b''
+    block_regex = re.compile(pattern.encode(), re.MULTILINE)
+
+    def search(block):
+        if block_regex.search(block):
+            for line in block.split(b'\n'):
+                if line and regex.search(line):
+                    stamp, line = split_stamp(line)
+                    if (since is None or (stamp or 0) >= since) and (
+                        until is None or (stamp or 0) <= until
+                    ):
+                        matches.append((name, stamp, line))
+
+    with open_log(path) as f:
+        pos = 0
+        if start:
+            f.seek(start - 1)
+            # this line started in the previous range
+            pos = start - 1 + len(f.readline())
+        while end is None or pos < end:
+            chunk = f.read(GREP_CHUNK)
+            if not chunk:
+                search(rest)
+                break
+            block = rest + chunk
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+            if end is not None and pos + len(block) > end:
+                block = block[:block.find(b'\n', end - pos - 1) + 1]
+            search(block)
+            pos += len(block)
+    return matches
+
+
+def print_lines(lines, header=None):
+    if header:
+        print(f"==> {header} <==")
+    sys.stdout.flush()
+    sys.stdout.buffer.writelines(line + b'\n' for line in lines)
+    sys.stdout.buffer.flush()
+
+
+class Inotify:
+    """A minimal ctypes binding to Linux's inotify"""
+
+    IN_MODIFY, IN_MOVED_TO, IN_CREATE = 0x2, 0x80, 0x100
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+
+    def __init__(self):
+        import ctypes
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), f"Can't watch {path}")
+        self.paths[wd] = path
+
+    def events(self):
+        """Yield (watched path, mask, name) for each pending event"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode()
+            offset += 16 + length
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            else:
+                yield self.paths.get(wd), mask, name
+
+
+class LogFollower:
+    """Print new lines from many loggers' current files as one prefixed stream, woken by inotify"""
+
+    def __init__(self, logs_dir, names, skip=None, count=10, follow_new=False, on_lines=None):
+        self.logs_dir, self.skip, self.count = logs_dir, skip, count
+        if on_lines:  # rather than printing them
+            self.emit = on_lines
+        self.files, self.partial = {}, {}
+        self.inotify = Inotify()
+        if follow_new:
+            self.inotify.watch(logs_dir, Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        log_dir = self.logs_dir / name
+        with suppress(OSError):
+            self.inotify.watch(
+                log_dir, Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_MOVED_TO
+            )
+            self.reopen(name, initial=True)
+
+    def reopen(self, name, initial=False):
+        if name in self.files:
+            self.read(name)
+            self.files.pop(name).close()
+        log = self.logs_dir / name / 'current'
+        try:
+            f = open(log, 'rb')
+        except FileNotFoundError:
+            return
+        self.files[name] = f
+        if initial and self.skip is None:
+            f.seek(0, os.SEEK_END)
+            self.emit(name, last_lines(log, self.count))
+        elif initial:
+            self.emit(name, (line.rstrip(b'\n') for line in islice(f, self.skip, None)))
+        else:
+            self.read(name)
+
+    def read(self, name):
+        data = self.partial.pop(name, b'') + self.files[name].read()
+        *lines, rest = data.split(b'\n')
+        if rest:
+            self.partial[name] = rest
+        self.emit(name, lines)
+
+    def emit(self, name, lines):
+        prefix = f"{name:<20}" | blue
+        for line in lines:
+            print(prefix, line.decode(errors='replace'))
+        sys.stdout.flush()
+
+    def on_events(self):
+        for path, mask, name in self.inotify.events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                for svc in tuple(self.files):
+                    self.read(svc)
+            elif path == self.logs_dir:
+                if mask & Inotify.IN_ISDIR:
+                    self.add(name)
+            elif name == 'current':
+                svc = os.path.basename(path)
+                if mask & Inotify.IN_MODIFY and svc in self.files:
+                    self.read(svc)
+                else:
+                    self.reopen(svc)
+
+    def run(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        loop.add_reader(self.inotify.fd, self.on_events)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+
+class StatusWatcher:
+    """Call on_change with a service's stats whenever its state changes, woken by s6's events"""
+
+    # Fields which only move with the clock, and so aren't changes of state
+    CLOCK_COLS = ('updownfor', 'readyfor')
+
+    def __init__(self, svcs, on_change):
+        self.on_change = on_change
+        self.cache = StatusCache()
+        self.states = {}
+        self.fifos = {}  # fd: (svc, fifo path, keepalive fd)
+        self.inotify = None
+        for svc in svcs:
+            self.states[svc] = self.state(svc)
+            try:
+                self.subscribe(svc)
+            except OSError:
+                self.watch(svc)
+
+    def state(self, svc):
+        with suppress(OSError):
+            stats = self.cache.get(svc)
+            return {col: val for col, val in stats.items() if col not in self.CLOCK_COLS}
+
+    def subscribe(self, svc):
+        """Listen on svc's supervise/event fifodir, the way s6-svwait does (ftrigr)"""
+        now = time.time()
+        label = tai64n_label(int(now) + TAI64_UNIX_OFFSET, int(now % 1 * 1e9))
+        fifo = svc / 'supervise' / 'event' / f"ftrig1:{label}:{os.urandom(8).hex()}"
+        os.mkfifo(fifo, 0o622)
+        try:
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            # Holding a writer too means the fifo never reads as EOF between events
+            keepalive = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            os.unlink(fifo)
+            raise
+        self.fifos[fd] = (svc, fifo, keepalive)
+
+    def watch(self, svc):
+        """Fall back to noticing s6-supervise replacing supervise/status, if we can't subscribe"""
+        if not self.inotify:
+            self.inotify = Inotify()
+        try:
+            self.inotify.watch(
+                svc / 'supervise', Inotify.IN_MOVED_TO | Inotify.IN_CREATE | Inotify.IN_MODIFY
+            )
+        except OSError as e:
+            warn(f"Can't watch {svc}: {e.strerror}")
+
+    def check(self, svc):
+        state = self.state(svc)
+        if state != self.states.get(svc):
+            self.states[svc] = state
+            if state:
+                self.on_change(svc, self.cache.get(svc))
+
+    def on_event(self, fd):
+        with suppress(BlockingIOError):
+            while os.read(fd, 4096):
+                pass
+        self.check(self.fifos[fd][0])
+
+    def on_inotify(self):
+        for path, mask, name in self.inotify.events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                for svc in self.states:
+                    self.check(svc)
+            elif name == 'status':
+                self.check(path.up())
+
+    def close(self):
+        for fd, (svc, fifo, keepalive) in self.fifos.items():
+            os.close(fd)
+            os.close(keepalive)
+            with suppress(OSError):
+                os.unlink(fifo)
+        self.fifos.clear()
+        if self.inotify:
+            os.close(self.inotify.fd)
+
+    def run(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        for fd in self.fifos:
+            loop.add_reader(fd, self.on_event, fd)
+        if self.inotify:
+            loop.add_reader(self.inotify.fd, self.on_inotify)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+            self.close()
+
+
+def svc_tags(svc):
+    """Tags listed in svc's tags file, for selecting services as @tag"""
+    try:
+        return (svc / 'tags').read().split()
+    except OSError:
+        return ()
+
+
+def svc_deps(svc):
+    """Names of the services svc needs, from its dependencies file and/or dependencies.d folder"""
+    deps = set()
+    with suppress(OSError):
+        deps.update((svc / 'dependencies').read().split())
+    with suppress(OSError):
+        deps.update(os.listdir(svc / 'dependencies.d'))
+    return deps
+
+
+def dep_waves(svcs):
+    """Group svcs into waves which only depend on services in earlier waves"""
+    svcs = {svc.name: svc for svc in svcs}
+    deps = {}
+    for name, svc in svcs.items():
+        deps[name] = svc_deps(svc)
+        for missing in (dep for dep in deps[name] if 'run' not in svc.up() / dep):
+            warn(f"{svc} depends on {missing}, which doesn't exist")
+        deps[name].intersection_update(svcs)
+    waves = []
+    while deps:
+        wave = [name for name, needs in deps.items() if not needs]
+        if not wave:
+            fail(1, f"Dependency cycle among: {', '.join(sorted(deps))}")
+        waves.append([svcs[name] for name in wave])
+        for name in wave:
+            del deps[name]
+        for needs in deps.values():
+            needs.difference_update(wave)
+    return waves
+
+
+def format_index(args):
+    """The index of the arg holding a subcommand's --format value, or None"""
+    for idx, arg in enumerate(args):
+        if arg == '--format' and idx + 1 < len(args):
+            return idx + 1
+        if arg.startswith('--format='):
+            return idx
+    return None
+
+
+def output_format(args):
+    """The --format given among a subcommand's args, or text"""
+    idx = format_index(args)
+    return 'text' if idx is None else args[idx].rpartition('=')[2]
+
+
+class Formatter(ColorApp):
+
+    output_format = SwitchAttr(
+        ['format'],
+        Set('text', 'json', 'ndjson'),
+        argname='FORMAT',
+        help=(
+            "print text, a JSON array, or one JSON object per line (NDJSON); "
+            "each record is written as soon as it's ready"
+        ),
+        default='text'
+    )
+
+    records = 0
+
+    def emit(self, record):
+        """Write one record now, in a JSON array or as an NDJSON line"""
+        import json
+        if self.output_format == 'json':
+            print(',\n' if self.records else '[', json.dumps(record), sep='', end='')
+        else:
+            print(json.dumps(record))
+        sys.stdout.flush()
+        self.records += 1
+
+    def end_records(self):
+        if self.output_format == 'json':
+            print(']' if self.records else '[]')
+
+
+class Jobber(ColorApp):
+
+    jobs = SwitchAttr(
+        ['j', 'jobs'],
+        Range(1, 1024),
+        argname='JOBS',
+        help=(
+            "act on up to JOBS services at once; "
+            "failures are reported together once all started jobs finish"
+        ),
+        default=1
+    )
+
+    def for_each(self, action, svcs):
+        """Call action on each svc, JOBS at a time, exiting on the first EssexError"""
+        if self.jobs == 1:
+            for svc in svcs:
+                try:
+                    action(svc)
+                except EssexError as e:
+                    warn(f"{svc.name}: {e}")
+                    fail(e.r, "Aborting!")
+            return
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        failures = []
+        with ThreadPoolExecutor(self.jobs) as pool:
+            jobs = {pool.submit(action, svc): svc for svc in svcs}
+            for job in as_completed(jobs):
+                if job.cancelled():  # after an earlier failure
+                    continue
+                try:
+                    job.result()
+                except EssexError as e:
+                    failures.append((jobs[job], e))
+                    for pending in jobs:
+                        pending.cancel()
+        if failures:
+            warn(f"{len(failures)} service(s) failed:")
+            for svc, e in sorted(failures, key=lambda failure: failure[0]):
+                warn(f"{svc.name}: {e}")
+            if any(job.cancelled() for job in jobs):
+                warn("Aborting!")
+            sys.exit(max(e.r for svc, e in failures))
+
+    def for_each_wave(self, action, svcs, reverse=False):
+        """Call action on svcs in dependency order (or reversed), wave by wave"""
+        waves = dep_waves(svcs)
+        for wave in reversed(waves) if reverse else waves:
+            self.for_each(action, wave)
+
+
+def wait_millis(secs):
+    """s6-svc's -T value for waiting up to secs seconds, or forever if 0, never rounding down to forever"""
+    return max(1, math.ceil(secs * 1000)) if secs > 0 else 0
+
+
+class Stopper(Jobber):
 
     fail_after = SwitchAttr(
         ['f', 'fail-after'],
@@ -131,40 +1293,127 @@ class Stopper(ColorApp):
         excludes=['fail-after']
     )
 
-    def stop(self, svc, announce=False):
+    def stop(self, svc, announce=False, timeout=0):
+        """Stop svc, waiting up to SECONDS, or timeout seconds if that's sooner"""
         if announce:
             print("Stopping", svc, ". . .")
         self.fail_after = self.fail_after or self.kill_after
-        r, out, err = s6_svc['-wD', '-d', '-T', int(self.fail_after * 1000), svc].run(retcode=None)
-        if r == 99:
-            warn(f"{svc} didn't stop in time!")
-            if self.kill_after:
-                warn(f"Sending kill signal to {svc}!")
-                s6_svc['-k', svc].run_fg()
-            else:
-                fail(1, "Aborting!")
-        elif r:
-            fail(r, out, err)
+        wait = min(filter(None, (self.fail_after, timeout)), default=0)
+        with phase('stop', svc):
+            r, out, err = cmds.s6_svc['-wD', '-d', '-T', wait_millis(wait), svc].run(retcode=None)
+            if r == 99:
+                if self.kill_after:
+                    warn(f"{svc} didn't stop in time!")
+                    warn(f"Sending kill signal to {svc}!")
+                    r, out, err = cmds.s6_svc['-k', svc].run(retcode=None)
+                    if r:
+                        raise EssexError(r, out, err)
+                else:
+                    raise EssexError(1, f"{svc} didn't stop in time!")
+            elif r:
+                raise EssexError(r, out, err)
 
     def is_up(self, svc):
         try:
-            return s6_svstat('-o', 'up', svc).strip() == 'true'
+            return self.parent.stats(svc)['up']
         except ProcessExecutionError as e:
             warn(f"{e}")
             return False
 
 
-class Starter(ColorApp):
+class Starter(Jobber):
+
+    start_timeout = SwitchAttr(
+        ['t', 'timeout'],
+        float,
+        argname='SECONDS',
+        help=(
+            "fail if a service isn't up after SECONDS seconds, "
+            "or ready, if it has a notification-fd file; "
+            "if 0, will not move on until it is"
+        ),
+        default=0
+    )
 
     def start(self, svc, announce=False, timeout=0):
-        # timeout not currently used
+        """Start svc and wait until it's up (or ready, if it notifies readiness), for up to SECONDS, or timeout seconds if that's sooner"""
         if announce:
             print("Starting", svc)
-        # s6_svc['-u', '-wu', '-T', timeout * 1000, svc].run_fg()
-        r, out, err = s6_svc['-u', '-wu', '-T', timeout * 1000, svc].run(retcode=None)
-        if r:
-            fail(r, out, err)
-            # warn(out, err)
+        wait = min(filter(None, (self.start_timeout, timeout)), default=0)
+        until = '-wU' if 'notification-fd' in svc else '-wu'
+        with phase('start', svc):
+            r, out, err = cmds.s6_svc['-u', until, '-T', wait_millis(wait), svc].run(retcode=None)
+        if r == 99:
+            raise EssexError(1, f"{svc} wasn't {'ready' if until == '-wU' else 'up'} in time!")
+        elif r:
+            raise EssexError(r, out, err)
+
+
+# Words given their own color, at any position: sh keywords and execline's block-taking programs
+SCRIPT_KEYWORDS = frozenset((
+    'case', 'do', 'done', 'elif', 'else', 'esac', 'exec', 'fi', 'for', 'function', 'if', 'in',
+    'then', 'until', 'while', 'backtick', 'background', 'define', 'elgetpositionals', 'emptyenv',
+    'export', 'foreground', 'forx', 'ifelse', 'ifte', 'ifthenelse', 'importas', 'multidefine',
+    'multisubstitute', 'pipeline', 'redirfd', 'fdmove', 'fdclose', 'withstdinas'
+))
+SCRIPT_TOKENS = re.compile(r"""
+    (?P<comment>(?:^|(?<=\s))\#.*$)
+  | (?P<string>'[^']*'?|"(?:\\.|[^"\\])*"?)
+  | (?P<var>\$(?:\{[^}\s]*\}?|[A-Za-z_]\w*|[0-9@*#?$!-]))
+  | (?P<punct>[{}();|&<>]+)
+  | (?P<word>[^\s'"$#{}();|&<>]+)
+""", re.MULTILINE | re.VERBOSE)
+HIGHLIGHTERS = (
+    ('highlight', ('--stdout', '-O', 'truecolor', '-s', 'moria', '-S', 'sh')),
+    ('bat', ('-p', '-l', 'sh', '--color', 'always', '--paging', 'never'))
+)
+
+
+def highlight_script(text):
+    """Colorize a sh or execline script, in-process, marking keywords and the commands they can see"""
+    # execline treats newlines as spaces, so only unindented lines (and blocks) begin commands
+    execline = 'execline' in text.partition('\n')[0]
+    parts, end, command_next = [], 0, True
+    for match in SCRIPT_TOKENS.finditer(text):
+        space = text[end:match.start()]
+        parts.append(space)
+        if '\n' in space:
+            command_next = not (execline and space.rpartition('\n')[2])
+        kind, token = match.lastgroup, match.group()
+        end = match.end()
+        if kind == 'word':
+            if token in SCRIPT_KEYWORDS:
+                parts.append(token | yellow)
+                command_next = not execline
+            elif command_next and not (token[0] in '-0123456789' or '=' in token):
+                parts.append(token | green)
+                command_next = False
+            else:
+                # options, fds, and VAR=val assignments may come before a command
+                parts.append(token)
+                command_next = command_next and (token[0] in '-0123456789' or '=' in token)
+        else:
+            parts.append(token | {
+                'comment': blue, 'string': red, 'var': magenta, 'punct': yellow
+            }[kind])
+            if kind == 'punct':
+                command_next = token[-1] in '{(;|&' and not ('<' in token or '>' in token)
+    parts.append(text[end:])
+    return ''.join(parts)
+
+
+def page(text):
+    """Print text in one write, or through $PAGER (or less) if it's more than a terminal screenful"""
+    if sys.stdout.isatty():
+        import shlex, shutil
+        if text.count('\n') >= shutil.get_terminal_size().lines:
+            pager = shlex.split(local.env.get('PAGER') or 'less')
+            with suppress(CommandNotFound, IndexError):
+                with local.env(LESS=local.env.get('LESS', 'FRX')):
+                    (local[pager[0]][pager[1:]] << text).run(retcode=None, stdout=None, stderr=None)
+                return
+    sys.stdout.write(text)
+    sys.stdout.flush()
 
 
 @Essex.subcommand('print')
@@ -186,48 +1435,62 @@ class EssexPrint(ColorApp):
         help="only print contents of enabled services (configured to be running)"
     )
 
-    def display(self, docpath):
-        title_cat = tail['-vn', '+1', docpath]
-        if self.no_color:
-            title_cat.run_fg()
-        else:
-            try:
-                (
-                    title_cat |
-                    local['highlight'][
-                        '--stdout', '-O', 'truecolor', '-s', 'moria', '-S', 'sh'
-                    ]
-                ).run_fg()
-            except CommandNotFound:
-                try:
-                    (
-                        title_cat |
-                        local['bat']['-p', '-l', 'sh']
-                    ).run_fg()
-                except CommandNotFound:
-                    title_cat.run_fg()
-        print('\n')
-
-    def main(self, *svc_names):
-        errors = False
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
+    external = Flag(
+        ['x', 'external-highlighter'],
+        help=(
+            "colorize with highlight or bat, if found, in one process for all files, "
+            "rather than with the built-in sh/execline highlighting"
+        ),
+        excludes=['no-color']
+    )
+
+    no_pager = Flag(
+        ['P', 'no-pager'],
+        help="print straight to the terminal, even when there's more than a screenful"
+    )
+
+    # Looked up once per process, kept for essex batch and serve
+    highlighter = None
+
+    @staticmethod
+    def external_highlighter():
+        """The first of highlight or bat in PATH, or False"""
+        if EssexPrint.highlighter is None:
+            EssexPrint.highlighter = False
+            for name, args in HIGHLIGHTERS:
+                with suppress(CommandNotFound):
+                    EssexPrint.highlighter = local[name][args]
+                    break
+        return EssexPrint.highlighter
+
+    def display(self, docpath, colorize=None):
+        """docpath's contents, titled like tail -v does"""
+        with open(docpath, encoding='utf-8', errors='replace') as doc:
+            text = doc.read()
+        if text and not text.endswith('\n'):
+            text += '\n'
+        return f"==> {docpath} <==\n{colorize(text) if colorize else text}\n\n"
+
+    def main(self, *selectors):
+        highlighter = self.external and self.external_highlighter()
+        colorize = None if self.no_color or highlighter else highlight_script
+        texts, errors = [], False
+        for svc in self.parent.select(selectors):
             if self.enabled_only and 'down' in svc:
                 continue
-            found = False
-            for file in ('run',) if self.run_only else ('run', 'finish', 'crash'):
-                # if (runfile := svc / file).is_file():
-                runfile = svc / file  #
-                if runfile.is_file():  #
-                    self.display(runfile)
-                    found = True
-            # if not self.run_only and (logger := svc / 'log' / 'run').is_file():
-            logger = svc / 'log' / 'run'  #
-            if not self.run_only and logger.is_file():  #
-                self.display(logger)
-                found = True
-            if not found:
+            files = ('run',) if self.run_only else ('run', 'finish', 'crash', 'log/run')
+            docpaths = [svc / file for file in files if (svc / file).is_file()]
+            if not docpaths:
                 warn(f"{svc} doesn't exist")
                 errors = True
+            texts.extend(self.display(docpath, colorize) for docpath in docpaths)
+        text = ''.join(texts)
+        if highlighter:
+            text = (highlighter << text)()
+        if self.no_pager:
+            sys.stdout.write(text)
+        else:
+            page(text)
         if errors:
             fail(1)
 
@@ -241,24 +1504,26 @@ class EssexCat(EssexPrint):
 class EssexStart(Starter):
     """Start (all or specified) services"""
 
-    def main(self, *svc_names):
+    def main(self, *selectors):
         self.parent.fail_if_unsupervised()
-        s6_svscanctl('-a', self.parent.svcs_dir)
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
-            self.start(svc)
+        cmds.s6_svscanctl('-a', self.parent.svcs_dir)
+        self.for_each_wave(self.start, self.parent.select(selectors))
 
 
 @Essex.subcommand('stop')
 class EssexStop(Stopper):
     """Stop (all or specified) services"""
 
-    def main(self, *svc_names):
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
-            self.stop(svc, announce=True)
+    def main(self, *selectors):
+        self.for_each_wave(
+            lambda svc: self.stop(svc, announce=True),
+            self.parent.select(selectors),
+            reverse=True
+        )
 
 
 @Essex.subcommand('list')
-class EssexList(ColorApp):
+class EssexList(Formatter):
     """List all known services"""
 
     enabled_only = Flag(
@@ -266,95 +1531,276 @@ class EssexList(ColorApp):
         help="only list enabled services (configured to be running)"
     )
 
-    def main(self):
-        if self.parent.svcs_dir.is_dir():
-            if self.enabled_only:
-                print(*(s for s in self.parent.svcs if 'down' not in s), sep='\n')
-            else:
-                print(*self.parent.svcs, sep='\n')
+    def main(self, *selectors):
+        if not self.parent.svcs_dir.is_dir():
+            return
+        svcs = (
+            s for s in self.parent.select(selectors) if not self.enabled_only or 'down' not in s
+        )
+        if self.output_format == 'text':
+            print(*svcs, sep='\n')
+            return
+        for svc in svcs:
+            self.emit({'name': svc.name, 'path': str(svc), 'enabled': 'down' not in svc})
+        self.end_records()
 
 
 @Essex.subcommand('status')
-class EssexStatus(ColorApp):
+class EssexStatus(Formatter):
     """View the current states of (all or specified) services"""
 
     enabled_only = Flag(
         ['e', 'enabled'],
         help="only list enabled services (configured to be running)"
     )
+    watch = Flag(
+        ['w', 'watch'],
+        help="keep running, and print another line each time a service changes state"
+    )
+
+    def show(self, svc, stats, when=''):
+        if self.output_format != 'text':
+            self.emit({'name': svc.name, **{col: stats[col] for col in SVSTAT_COLS}})
+            return
+        statline = f"{svc.name:<20} {'up' if stats['up'] else 'down':<5} {str(stats['updownfor']) + 's':<10} {stats['pid'] if stats['up'] else stats['exitcode']:<6} {'autorestarts' if stats['wantedup'] else '':<13} {'autostarts' if stats['normallyup'] else '':<11}"
+        statline = statline | (green if stats['up'] else red)
+        print(f"{when | blue} {statline}" if when else statline)
+        sys.stdout.flush()
+
+    def on_change(self, svc, stats):
+        self.show(svc, stats, time.strftime('%H:%M:%S'))
 
-    def main(self, *svc_names):
+    def main(self, *selectors):
         self.parent.fail_if_unsupervised()
-        s6_svscanctl('-a', self.parent.svcs_dir)
-        cols = (
-            'up', 'wantedup', 'normallyup', 'ready', 'paused', 'pid',
-            'exitcode', 'signal', 'signum', 'updownsince', 'readysince',
-            'updownfor', 'readyfor'
-        )
+        cmds.s6_svscanctl('-a', self.parent.svcs_dir)
         errors = False
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
+        shown = []
+        for svc in self.parent.select(selectors):
             if 'run' in svc:
                 if self.enabled_only and 'down' in svc:
                     continue
-                stats = {
-                    col: False if val == 'false' else val
-                    for col, val in zip(
-                        cols, s6_svstat('-o', ','.join(cols), svc).split()
-                    )
-                }
-                statline = f"{svc.name:<20} {'up' if stats['up'] else 'down':<5} {stats['updownfor'] + 's':<10} {stats['pid'] if stats['pid'] != '-1' else stats['exitcode']:<6} {'autorestarts' if stats['wantedup'] else '':<13} {'autostarts' if stats['normallyup'] else '':<11}"
-                print(statline | (green if stats['up'] else red))
+                self.show(svc, self.parent.stats(svc))
+                shown.append(svc)
             else:
                 warn(f"{svc} doesn't exist")
                 errors = True
+        if self.watch:
+            self.parent.fail_if_serving('essex status --watch')
+            with suppress(KeyboardInterrupt):
+                StatusWatcher(shown, self.on_change).run()
+        self.end_records()
         if errors:
             fail(1)
 
 
+@Essex.subcommand('metrics')
+class EssexMetrics(ColorApp):
+    """Export all services' states in the Prometheus text format, to a file or over HTTP"""
+
+    output = SwitchAttr(
+        ['o', 'output'],
+        local.path,
+        argname='FILE',
+        help="write metrics to FILE (atomically), as for node_exporter's textfile collector",
+        excludes=['port']
+    )
+
+    port = SwitchAttr(
+        ['p', 'port'],
+        Range(1, 65535),
+        argname='PORT',
+        help="serve metrics over HTTP on PORT"
+    )
+
+    bind = SwitchAttr(
+        ['b', 'bind'],
+        argname='ADDRESS',
+        help="listen on ADDRESS when serving over HTTP",
+        default='127.0.0.1'
+    )
+
+    interval = SwitchAttr(
+        ['i', 'interval'],
+        float,
+        argname='SECONDS',
+        help="keep rewriting FILE every SECONDS seconds; if 0, write it once",
+        default=0
+    )
+
+    METRICS = (
+        ('up', 'gauge', "Whether the service is up"),
+        ('wantedup', 'gauge', "Whether the supervisor will restart the service when it dies"),
+        ('normallyup', 'gauge', "Whether the service is enabled (has no down file)"),
+        ('ready', 'gauge', "Whether the service is up and has notified readiness"),
+        ('uptime_seconds', 'gauge', "Seconds since the service came up, or 0 if down"),
+        ('state_seconds', 'gauge', "Seconds since the service last went up or down"),
+        ('last_exit_code', 'gauge', "Exit code of the service's last death, or -1"),
+        ('last_signal', 'gauge', "Number of the signal which last killed the service, or -1"),
+        ('restarts_total', 'counter', "Times the service came up again while being exported")
+    )
+
+    def main(self, *selectors):
+        if self.port or self.interval:
+            self.parent.fail_if_serving('essex metrics --port/--interval')
+        self.cache, self.selectors = StatusCache(), selectors
+        if self.port:
+            self.serve()
+        elif self.output:
+            with suppress(KeyboardInterrupt):
+                while True:
+                    tmp = self.output.with_name(f".{self.output.name}.{os.getpid()}")
+                    tmp.write(self.render())
+                    os.replace(tmp, self.output)
+                    if not self.interval:
+                        break
+                    time.sleep(self.interval)
+        else:
+            print(self.render(), end='')
+
+    def render(self):
+        samples = {name: [] for name, kind, doc in self.METRICS}
+        for svc in self.parent.select(self.selectors):
+            try:
+                stats = self.cache.get(svc)
+            except (OSError, ProcessExecutionError):
+                continue
+            label = '{service="%s"}' % svc.name.replace('\\', '\\\\').replace('"', '\\"')
+            for name in ('up', 'wantedup', 'normallyup', 'ready'):
+                samples[name].append(f"{label} {int(stats[name])}")
+            samples['uptime_seconds'].append(f"{label} {stats['updownfor'] if stats['up'] else 0}")
+            samples['state_seconds'].append(f"{label} {stats['updownfor']}")
+            samples['last_exit_code'].append(f"{label} {stats['exitcode']}")
+            samples['last_signal'].append(f"{label} {stats['signum']}")
+            samples['restarts_total'].append(f"{label} {self.cache.restarts.get(svc, 0)}")
+        lines = []
+        for name, kind, doc in self.METRICS:
+            lines.append(f"# HELP essex_service_{name} {doc}")
+            lines.append(f"# TYPE essex_service_{name} {kind}")
+            lines.extend(f"essex_service_{name}{sample}" for sample in samples[name])
+        return '\n'.join(lines) + '\n'
+
+    def serve(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        render = self.render
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        with suppress(KeyboardInterrupt):
+            HTTPServer((self.bind, self.port), MetricsHandler).serve_forever()
+
+
 @Essex.subcommand('pid')
-class EssexPid(ColorApp):
+class EssexPid(Formatter):
     """Print the PIDs of running services, or s6-svscan (supervision root) if none specified"""
 
-    def main(self, *svc_names):
+    def show(self, name, pid):
+        if self.output_format == 'text':
+            print(pid)
+        else:
+            self.emit({'name': name, 'pid': int(pid)})
+
+    def main(self, *selectors):
         self.parent.fail_if_unsupervised()
-        if not svc_names:
-            print(self.parent.root_pid)
+        if not selectors:
+            self.show('s6-svscan', self.parent.root_pid)
+            self.end_records()
         else:
             errors = False
-            for svc in self.parent.svc_map(svc_names):
+            for svc in self.parent.select(selectors):
                 try:
-                    pid = s6_svstat('-p', svc).strip()
+                    pid = self.parent.stats(svc)['pid']
                 except ProcessExecutionError as e:
                     warn(f"{e}")
                     errors = True
                 else:
-                    if pid == '-1':
+                    if pid == -1:
                         warn(f"{svc} is not running")
                         errors = True
                     else:
-                        print(pid)
+                        self.show(svc.name, pid)
+            self.end_records()
             if errors:
                 fail(1)
 
 
 @Essex.subcommand('tree')
 class EssexTree(ColorApp):
-    """View the process tree from the supervision root"""
+    """View the process tree from the supervision root, with each service's total RSS, CPU time, and threads"""
 
     quiet = Flag(
         ['q', 'quiet'],
         help=(
             "don't print childless supervisors, s6-log processes, or s6-log supervisors; "
-            "has no effect when pstree is provided by busybox"
+            "has no effect when /proc is unavailable and pstree is provided by busybox"
         )
     )
 
     def main(self):
         self.parent.fail_if_unsupervised()
+        root = int(self.parent.root_pid)
+        try:
+            procs = proc_table()
+        except OSError:
+            procs = {}
+        if root in procs:
+            children = {}
+            for pid, proc in sorted(procs.items()):
+                children.setdefault(proc['ppid'], []).append(pid)
+            print('\n'.join(self.render(root, procs, children)))
+        else:
+            self.pstree()
+
+    def subtree(self, pid, children):
+        yield pid
+        for child in children.get(pid, ()):
+            yield from self.subtree(child, children)
+
+    def visible_children(self, pid, procs, children):
+        kids = children.get(pid, [])
+        if self.quiet:
+            kids = [
+                kid for kid in kids
+                if procs[kid]['comm'] != 's6-log' and (
+                    procs[kid]['comm'] != 's6-supervise' or
+                    self.visible_children(kid, procs, children)
+                )
+            ]
+        return kids
+
+    def render(self, pid, procs, children, prefix='', last=True, depth=0):
+        """Lines of pid's tree in pstree -apT style, annotating service supervisors with their totals"""
+        proc = procs[pid]
+        line = f"{prefix}{('`-' if last else '|-') if depth else ''}{proc['comm']},{pid} {' '.join(proc['args'])}".rstrip()
+        if depth == 1 and proc['comm'] == 's6-supervise':
+            descendants = [procs[p] for p in self.subtree(pid, children) if p != pid]
+            if descendants:
+                line += (
+                    f"  [{human_bytes(sum(d['rss'] for d in descendants))} RSS, "
+                    f"{human_seconds(sum(d['ticks'] for d in descendants) / CLK_TCK)} CPU, "
+                    f"{sum(d['threads'] for d in descendants)} threads]"
+                ) | yellow
+        yield line
+        prefix += ('    ' if last else '|   ') if depth else '  '
+        kids = self.visible_children(pid, procs, children)
+        for idx, kid in enumerate(kids):
+            yield from self.render(kid, procs, children, prefix, idx == len(kids) - 1, depth + 1)
+
+    def pstree(self):
         try:
-            readlink(pstree)
+            cmds.readlink(cmds.pstree)
         except:  # real pstree
-            tree = pstree['-apT', self.parent.root_pid]()
+            tree = cmds.pstree['-apT', self.parent.root_pid]()
             if self.quiet:
                 tl = tree.splitlines()
                 whitelist = set(range(len(tl)))
@@ -367,17 +1813,157 @@ class EssexTree(ColorApp):
                         whitelist.discard(i - 1)
                 tree = '\n'.join(tl[i] for i in sorted(whitelist))
         else:  # busybox pstree
-            tree = pstree['-p', self.parent.root_pid]()
+            tree = cmds.pstree['-p', self.parent.root_pid]()
         print(tree)
 
 
+@Essex.subcommand('top')
+class EssexTop(ColorApp):
+    """Watch each service's CPU, memory, IO, and open file totals, live"""
+
+    interval = SwitchAttr(
+        ['i', 'interval'],
+        float,
+        argname='SECONDS',
+        help="refresh every SECONDS seconds",
+        default=2
+    )
+
+    iterations = SwitchAttr(
+        ['n', 'iterations'],
+        int,
+        argname='COUNT',
+        help="exit after COUNT refreshes; if 0, run until interrupted",
+        default=0
+    )
+
+    def main(self, *selectors):
+        self.parent.fail_if_serving('essex top')
+        self.svcs = tuple(self.parent.select(selectors))
+        self.mains = {}  # svc: (supervise/status mtime, main pid)
+        self.files = {}  # pid: open /proc files, for up to max_cached pids
+        self.last = {}  # pid: (ticks, read bytes, written bytes)
+        import resource
+        # three handles per pid, leaving plenty of fds for everything else
+        self.max_cached = max(0, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 256) // 3
+        clear = '\x1b[H\x1b[2J' if sys.stdout.isatty() else ''
+        then = time.monotonic()
+        self.sample(1)
+        with suppress(KeyboardInterrupt):
+            for tick in range(self.iterations or sys.maxsize):
+                time.sleep(self.interval)
+                now = time.monotonic()
+                rows = self.sample(now - then)
+                then = now
+                print(clear + self.table(rows), flush=True)
+
+    def main_pid(self, svc):
+        """svc's main PID, re-decoded from supervise/status only when that changes, or None if unknown"""
+        try:
+            mtime = os.stat(svc / 'supervise' / 'status').st_mtime_ns
+        except OSError:
+            return -1
+        cached = self.mains.get(svc)
+        if not cached or cached[0] != mtime:
+            try:
+                cached = self.mains[svc] = (mtime, svstat(svc)['pid'])
+            except ProcessExecutionError:
+                cached = self.mains[svc] = (mtime, -1)
+            except OSError:  # like EMFILE, so try again next time
+                return None
+        return cached[1]
+
+    def descendants(self, pid):
+        yield pid
+        with suppress(OSError):
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{tid}/children") as children:
+                    for child in children.read().split():
+                        yield from self.descendants(int(child))
+
+    def read(self, pid):
+        """CPU ticks, threads, RSS bytes, read bytes, written bytes, and open files for pid, reusing open handles"""
+        stats = {}
+        if pid in self.files:
+            for name, f in self.files[pid].items():
+                f.seek(0)
+                stats[name] = f.read().decode()
+        elif len(self.files) < self.max_cached:
+            files = self.files[pid] = {}
+            for name in ('stat', 'statm', 'io'):
+                with suppress(OSError):
+                    files[name] = f = open(f"/proc/{pid}/{name}", 'rb', buffering=0)
+                    stats[name] = f.read().decode()
+        else:  # past the cap, open and close them each time
+            for name in ('stat', 'statm', 'io'):
+                with suppress(OSError), open(f"/proc/{pid}/{name}", 'rb', buffering=0) as f:
+                    stats[name] = f.read().decode()
+        proc = parse_proc_stat(stats['stat'])
+        io_bytes = dict(
+            line.split(': ') for line in stats.get('io', '').splitlines()
+        )
+        try:
+            fds = os.stat(f"/proc/{pid}/fd").st_size or len(os.listdir(f"/proc/{pid}/fd"))
+        except OSError:
+            fds = 0
+        return (
+            proc['ticks'], proc['threads'], int(stats['statm'].split()[1]) * PAGE_SIZE,
+            int(io_bytes.get('read_bytes', 0)), int(io_bytes.get('write_bytes', 0)), fds
+        )
+
+    def sample(self, elapsed):
+        rows, seen = [], set()
+        for svc in self.svcs:
+            row = {'svc': svc.name, 'pids': 0, 'cpu': 0.0, 'threads': 0, 'rss': 0, 'read': 0.0, 'written': 0.0, 'fds': 0}
+            pid = self.main_pid(svc)
+            if pid is None:
+                row['pids'] = '?'
+                rows.append(row)
+                continue
+            for proc in self.descendants(pid) if pid > 0 else ():
+                try:
+                    ticks, threads, rss, read, written, fds = self.read(proc)
+                except (OSError, KeyError, ValueError, IndexError):
+                    continue
+                seen.add(proc)
+                last_ticks, last_read, last_written = self.last.get(proc, (ticks, read, written))
+                self.last[proc] = (ticks, read, written)
+                row['pids'] += 1
+                row['cpu'] += (ticks - last_ticks) / CLK_TCK / elapsed * 100
+                row['threads'] += threads
+                row['rss'] += rss
+                row['read'] += (read - last_read) / elapsed
+                row['written'] += (written - last_written) / elapsed
+                row['fds'] += fds
+            rows.append(row)
+        for gone in set(self.files) - seen:
+            for f in self.files.pop(gone).values():
+                f.close()
+            self.last.pop(gone, None)
+        return rows
+
+    def table(self, rows):
+        lines = [
+            f"{'SERVICE':<20} {'PIDS':>5} {'CPU%':>6} {'THREADS':>7} {'RSS':>10} "
+            f"{'READ/s':>10} {'WRITE/s':>10} {'FDS':>5}" | yellow
+        ]
+        for row in sorted(rows, key=lambda row: (-row['cpu'], -row['rss'], row['svc'])):
+            line = (
+                f"{row['svc']:<20} {row['pids']:>5} {row['cpu']:>6.1f} {row['threads']:>7} "
+                f"{human_bytes(row['rss']):>10} {human_bytes(row['read']):>10} "
+                f"{human_bytes(row['written']):>10} {row['fds']:>5}"
+            )
+            lines.append(line | (yellow if row['pids'] == '?' else green if row['pids'] else red))
+        return '\n'.join(lines)
+
+
 @Essex.subcommand('enable')
 class EssexEnable(ColorApp):
     """Configure (all or specified) services to be up, without actually starting them"""
 
-    def main(self, *svc_names):
+    def main(self, *selectors):
         errors = False
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
+        for svc in self.parent.select(selectors):
             if svc.is_dir():
                 (svc / 'down').delete()
             else:
@@ -391,9 +1977,9 @@ class EssexEnable(ColorApp):
 class EssexDisable(ColorApp):
     """Configure (all or specified) services to be down, without actually stopping them"""
 
-    def main(self, *svc_names):
+    def main(self, *selectors):
         errors = False
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
+        for svc in self.parent.select(selectors):
             if svc.is_dir():
                 (svc / 'down').touch()
             else:
@@ -408,12 +1994,13 @@ class EssexOn(ColorApp):
     """Start supervising all services"""
 
     def main(self):
+        self.parent.fail_if_serving('essex on')
         self.parent.logs_dir.mkdir()
-        r, out, err = s6_svscanctl[self.parent.svcs_dir].run(retcode=None)
+        r, out, err = cmds.s6_svscanctl[self.parent.svcs_dir].run(retcode=None)
         if r == 100:
             (
-                fdmove['-c', '2', '1'][s6_svscan][self.parent.svcs_dir] |
-                s6_log['T', self.parent.logs_dir / '.s6-svscan']
+                cmds.fdmove['-c', '2', '1'][cmds.s6_svscan][self.parent.svcs_dir] |
+                cmds.s6_log['T', self.parent.logs_dir / '.s6-svscan']
             ).run_bg()
         elif r:
             fail(r, out, err)
@@ -427,50 +2014,240 @@ class EssexOff(Stopper):
 
     def main(self):
         self.parent.fail_if_unsupervised()
-        for svc in self.parent.svcs:
-            self.stop(svc, announce=self.is_up(svc))
+        self.for_each_wave(
+            lambda svc: self.stop(svc, announce=self.is_up(svc)),
             # yes, even when not is_up, to catch failed-start loops
-        s6_svscanctl['-anpt', self.parent.svcs_dir].run_fg()
+            self.parent.svcs,
+            reverse=True
+        )
+        cmds.s6_svscanctl['-anpt', self.parent.svcs_dir].run_fg()
 
 
 @Essex.subcommand('sync')
-class EssexSync(Stopper, Starter):
-    """Start or stop services to match their configuration"""
+class EssexSync(Stopper, Starter, Formatter):
+    """Start or stop services to match their configuration, planning it all first"""
+
+    dry_run = Flag(
+        ['n', 'dry-run'],
+        help="only print the plan: which services would be stopped or started, and why"
+    )
+
+    deadline = SwitchAttr(
+        ['deadline'],
+        float,
+        argname='SECONDS',
+        help=(
+            "give the whole sync SECONDS seconds, shortening waits to fit, "
+            "and skipping whatever hasn't begun by then"
+        ),
+        default=0
+    )
+
+    def plan(self, svcs):
+        """A step for each svc, from one read of each one's state and down file"""
+        steps = []
+        for svc in svcs:
+            wanted = 'down' not in svc
+            try:
+                stats = self.parent.stats(svc)
+            except ProcessExecutionError:
+                stats = {'up': False, 'wantedup': False}
+            if not wanted and (stats['up'] or stats['wantedup']):
+                # yes, even when not up, to catch failed-start loops
+                action, why = 'stop', "up" if stats['up'] else "restarting"
+            elif wanted and not stats['up']:
+                action, why = 'start', "down"
+            else:
+                action, why = None, "up" if wanted else "down"
+            steps.append({'svc': svc, 'action': action, 'why': why})
+        return steps
+
+    def show_plan(self, steps):
+        if self.output_format != 'text':
+            for step in steps:
+                self.emit({'name': step['svc'].name, 'action': step['action'], 'state': step['why']})
+            self.end_records()
+            return
+        for step in steps:
+            if step['action']:
+                print(f"{step['action']:<6} {step['svc'].name:<20} ({step['why']})")
+        print(
+            f"{sum(step['action'] == 'stop' for step in steps)} to stop, "
+            f"{sum(step['action'] == 'start' for step in steps)} to start, "
+            f"{sum(not step['action'] for step in steps)} already in sync"
+        )
 
-    def main(self, *svc_names):
+    def run_step(self, step, blocked):
+        """Carry out a step, unless blocked by a failed dependency or the deadline, and note its outcome"""
+        svc, started = step['svc'], time.monotonic()
+        timeout = self.ends - started if self.deadline else 0
+        if blocked:
+            step['outcome'] = f"skipped, as {', '.join(sorted(blocked))} failed"
+        elif self.deadline and timeout * 1000 < 1:  # less than a millisecond left
+            step['outcome'] = "skipped, past the deadline"
+        else:
+            try:
+                if step['action'] == 'stop':
+                    self.stop(svc, timeout=timeout)
+                else:
+                    self.start(svc, timeout=timeout)
+            except (EssexError, ProcessExecutionError) as e:
+                step['outcome'] = f"failed: {e}".strip()
+            else:
+                step['outcome'] = 'ok'
+        step['seconds'] = round(time.monotonic() - started, 3)
+
+    def run_steps(self, steps, reverse=False):
+        """Run steps in dependency waves (or reversed), JOBS at a time"""
+        from concurrent.futures import ThreadPoolExecutor
+        by_svc = {step['svc']: step for step in steps}
+        waves = dep_waves(by_svc)
+        # what must succeed first: dependencies when starting, dependents when stopping
+        needs = {svc: svc_deps(svc) for svc in by_svc}
+        if reverse:
+            needs = {
+                svc: {other.name for other in by_svc if svc.name in needs[other]}
+                for svc in by_svc
+            }
+        failed = set()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            for wave in reversed(waves) if reverse else waves:
+                jobs = [
+                    (svc, pool.submit(self.run_step, by_svc[svc], needs[svc] & failed))
+                    for svc in wave
+                ]
+                for svc, job in jobs:
+                    job.result()
+                    if by_svc[svc]['outcome'] != 'ok':
+                        failed.add(svc.name)
+
+    def report(self, steps):
+        if self.output_format != 'text':
+            for step in steps:
+                self.emit({
+                    'name': step['svc'].name, 'action': step['action'],
+                    'outcome': step['outcome'], 'seconds': step['seconds']
+                })
+            self.end_records()
+            return
+        for step in sorted(steps, key=lambda step: step['svc'].name):
+            color = green if step['outcome'] == 'ok' else (
+                yellow if step['outcome'].startswith('skipped') else red
+            )
+            print(
+                f"{step['svc'].name:<20} {step['action']:<6} {step['seconds']:>7.1f}s "
+                f"{step['outcome']}" | color
+            )
+
+    def main(self, *selectors):
+        self.ends = time.monotonic() + self.deadline
+        svcs = self.parent.select(selectors)
+        if self.dry_run:
+            self.show_plan(self.plan(svcs))
+            return
         self.parent.fail_if_unsupervised()
-        s6_svscanctl['-an', self.parent.svcs_dir].run_fg()
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
-            is_up = self.is_up(svc)
-            if (svc / 'down').exists():
-                self.stop(svc, announce=is_up)
-                # yes, even when not is_up, to catch failed-start loops
-            elif not is_up:
-                self.start(svc, announce=True)
+        cmds.s6_svscanctl['-an', self.parent.svcs_dir].run_fg()
+        steps = [step for step in self.plan(svcs) if step['action']]
+        self.run_steps([step for step in steps if step['action'] == 'stop'], reverse=True)
+        self.run_steps([step for step in steps if step['action'] == 'start'])
+        self.report(steps)
+        if any(step['outcome'] != 'ok' for step in steps):
+            fail(1)
 
 
 @Essex.subcommand('upgrade')
 class EssexUpgrade(Stopper, Starter):
-    """Restart (all or specified) running services whose run scripts have changed; Depends on the runfile generating an adjacent run.md5 file, like essex-generated runfiles do"""
+    """Restart (all or specified) running services or loggers whose run, finish, notification-fd, or env files have changed since launch"""
 
-    def main(self, *svc_names):
+    batch = SwitchAttr(
+        ['b', 'batch'],
+        Range(1, 1024),
+        argname='N',
+        help=(
+            "roll out N services at a time, in dependency order, "
+            "each batch coming back up (and ready, where notification-fd is set) before the next; "
+            "a batch that doesn't halts the rollout; "
+            "not for use with --jobs"
+        ),
+        default=0
+    )
+
+    max_unavailable = SwitchAttr(
+        ['m', 'max-unavailable'],
+        Range(1, 1024),
+        argname='M',
+        help="restart at most M services of a batch at once; the default is the whole batch",
+        requires=['batch'],
+        default=0
+    )
+
+    def main(self, *selectors):
+        if self.batch and self.jobs != 1:
+            fail(1, "--jobs doesn't apply to a --batch rollout; limit each batch with --max-unavailable instead")
         self.parent.fail_if_unsupervised()
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
-            if self.is_up(svc):
-                for run, run_md5 in (
-                    (svc / 'run', svc / 'run.md5'),
-                    (svc / 'log' / 'run', svc / 'log' / 'run.md5')
-                ):
-                    if run_md5.is_file():
-                        if md5(run.read().encode()).hexdigest() != run_md5.read().split()[0]:
-                            self.stop(run.up(), announce=True)
-                            self.start(run.up(), announce=True)
-                            break
+        self.index = ChangeIndex(self.parent.svcs_dir)
+        try:
+            if self.batch:
+                self.roll(self.parent.select(selectors))
+            else:
+                self.for_each_wave(self.upgrade, self.parent.select(selectors))
+        finally:
+            self.index.save()
+
+    def stale_units(self, svc):
+        """svc and/or its logger, where running with definitions changed since launch"""
+        units = []
+        for unit in (svc, svc / 'log'):
+            if 'run' not in unit:
+                continue
+            try:
+                stats = svstat(unit)
+            except ProcessExecutionError as e:
+                warn(f"{e}")
+                continue
+            if stats['up'] and self.index.changed(unit, stats):
+                units.append(unit)
+        return units
+
+    def upgrade(self, svc, units=None):
+        for unit in self.stale_units(svc) if units is None else units:
+            with phase('upgrade', unit):
+                self.stop(unit, announce=True)
+                self.start(unit, announce=True)
+                self.index.relaunched(unit)
+
+    def roll(self, svcs):
+        """Upgrade stale services batch by batch, halting at the first batch with a failure"""
+        from concurrent.futures import ThreadPoolExecutor
+        stale = {svc: units for svc, units in ((svc, self.stale_units(svc)) for svc in svcs) if units}
+        batches = [
+            wave[idx:idx + self.batch]
+            for wave in dep_waves(stale) for idx in range(0, len(wave), self.batch)
+        ]
+        with ThreadPoolExecutor(self.max_unavailable or self.batch) as pool:
+            for number, batch in enumerate(batches, 1):
+                print(
+                    f"Batch {number}/{len(batches)}: {', '.join(svc.name for svc in batch)}" | blue
+                )
+                jobs = [(svc, pool.submit(self.upgrade, svc, stale[svc])) for svc in batch]
+                failures = []
+                for svc, job in jobs:
+                    try:
+                        job.result()
+                    except (EssexError, ProcessExecutionError) as e:
+                        failures.append((svc, e))
+                if failures:
+                    for svc, e in failures:
+                        warn(f"{svc.name}: {e}")
+                    left = [svc.name for batch in batches[number:] for svc in batch]
+                    fail(1, f"Halting the rollout at batch {number}" + (
+                        f"; not yet upgraded: {', '.join(left)}" if left else ''
+                    ))
 
 
 @Essex.subcommand('reload')
 class EssexReload(EssexUpgrade):
-    """Restart (all or specified) running services whose run scripts have changed; Depends on the runfile generating an adjacent run.md5 file, like essex-generated runfiles do; Alias for upgrade; Deprecated"""
+    """Restart (all or specified) running services or loggers whose run, finish, notification-fd, or env files have changed since launch; Alias for upgrade; Deprecated"""
 
 
 @Essex.subcommand('pt')
@@ -489,7 +2266,7 @@ class EssexPapertrail(ColorApp):
         entries = '\n'.join(
             f"  - tag: {svc.name}\n"
             f"    path: {self.parent.logs_dir / svc.name / 'current'}"
-            for svc in self.parent.svcs
+            for svc in self.parent.select()
         )
         print(
             f"files:",
@@ -502,22 +2279,27 @@ class EssexPapertrail(ColorApp):
 
 
 @Essex.subcommand('log')
-class EssexLog(ColorApp):
-    """View (all or specified) services' current log files"""
+class EssexLog(Formatter):
+    """View (all or specified) services' log files"""
 
     lines = SwitchAttr(
         ['n', 'lines'],
         argname='LINES',
         help=(
-            "print only the last LINES lines from the service's current log file, "
-            "or prepend a '+' to start at line LINES"
+            "print only the last LINES lines from the service's logs, "
+            "reaching back into archived log files as needed, "
+            "or prepend a '+' to start at line LINES of the current log file"
         ),
         default='+1'
     )
 
     follow = Flag(
         ['f', 'follow'],
-        help="continue printing new lines as they are added to the log file"
+        help=(
+            "continue printing new lines as they are added to the log files, "
+            "as one stream prefixed by service name, "
+            "picking up log rotations and (if no services are specified) new services"
+        )
     )
 
     debug = Flag(
@@ -525,27 +2307,194 @@ class EssexLog(ColorApp):
         help="view the s6-svscan log file"
     )
 
-    def main(self, *svc_names):
-        logs = [
-            self.parent.logs_dir / svc.name / 'current'
-            for svc in self.parent.svc_map(svc_names or self.parent.svcs)
+    since = SwitchAttr(
+        ['s', 'since'],
+        timestamp,
+        argname='TIME',
+        help=(
+            "print only lines stamped at or after TIME, from current and archived log files; "
+            "TIME may be a TAI64N label, or a local 'YYYY-MM-DD[ HH:MM[:SS]]' or 'HH:MM[:SS]'"
+        ),
+        excludes=['follow']
+    )
+
+    until = SwitchAttr(
+        ['u', 'until'],
+        timestamp,
+        argname='TIME',
+        help="print only lines stamped at or before TIME, from current and archived log files",
+        excludes=['follow']
+    )
+
+    pattern = SwitchAttr(
+        ['g', 'grep'],
+        argname='PATTERN',
+        help=(
+            "print lines matching the regular expression PATTERN from current and archived "
+            "(including gzip, bzip2, xz, or zstd compressed) log files, searched in parallel, "
+            "tagged with service name and time, as they're found"
+        ),
+        excludes=['follow', 'lines']
+    )
+
+    def main(self, *selectors):
+        log_dirs = [
+            self.parent.logs_dir / svc.name
+            for svc in self.parent.select(selectors)
         ]
         if self.debug:
-            logs.append(self.parent.logs_dir / '.s6-svscan' / 'current')
+            log_dirs.append(self.parent.logs_dir / '.s6-svscan')
+        try:
+            skip = max(int(self.lines[1:]) - 1, 0) if self.lines.startswith('+') else None
+            count = abs(int(self.lines))
+        except ValueError:
+            fail(1, f"Invalid number of lines: {self.lines}")
         if self.follow:
+            self.parent.fail_if_serving('essex log --follow')
             with suppress(KeyboardInterrupt):
                 try:
-                    mtail = local.get('lnav', 'multitail')
-                except CommandNotFound:
-                    tail[['-n', self.lines, '-F'] + logs].run_fg()
+                    follower = LogFollower(
+                        self.parent.logs_dir, [log_dir.name for log_dir in log_dirs],
+                        skip, count, follow_new=not selectors,
+                        on_lines=None if self.output_format == 'text' else self.follow_records
+                    )
+                except (OSError, AttributeError):  # no inotify
+                    if self.output_format != 'text':
+                        fail(1, "Can't follow logs as records without inotify")
+                    self.follow_externally([log_dir / 'current' for log_dir in log_dirs])
                 else:
-                    mtail[logs].run_fg()
+                    follower.run()
+            self.end_records()
+            return
+        if self.pattern:
+            self.grep(log_dirs)
+        elif self.output_format == 'text':
+            self.print_logs(log_dirs, skip, count)
         else:
-            for log in logs:
+            self.emit_logs(log_dirs, skip, count)
+        self.end_records()
+
+    def line_records(self, name, lines, log):
+        for line in lines:
+            stamp, text = split_stamp(line)
+            self.emit({
+                'name': name, 'file': str(log), 'time': stamp,
+                'text': text.decode(errors='replace')
+            })
+
+    def follow_records(self, name, lines):
+        self.line_records(name, lines, self.parent.logs_dir / name / 'current')
+
+    def emit_logs(self, log_dirs, skip, count):
+        for log_dir in log_dirs:
+            if self.since is not None or self.until is not None:
+                for log in range_files(log_dir, self.since, self.until):
+                    with suppress(FileNotFoundError):
+                        rest = b''
+                        # blocks may split lines
+                        for block in log_range(log, self.since, self.until):
+                            *lines, rest = (rest + block).split(b'\n')
+                            self.line_records(log_dir.name, lines, log)
+                        if rest:
+                            self.line_records(log_dir.name, (rest,), log)
+            elif skip is not None:
+                log = log_dir / 'current'
                 if log.is_file():
-                    tail['-vn', self.lines, log].run_fg()
+                    with open_log(log) as f:
+                        self.line_records(
+                            log_dir.name,
+                            (line.rstrip(b'\n') for line in islice(f, skip, None)), log
+                        )
+            else:
+                for log, lines in tail_log(log_dir, count):
+                    self.line_records(log_dir.name, lines, log)
+
+    def print_logs(self, log_dirs, skip, count):
+        for log_dir in log_dirs:
+            if self.since is not None or self.until is not None:
+                found = False
+                for log in range_files(log_dir, self.since, self.until):
+                    with suppress(FileNotFoundError):
+                        blocks = log_range(log, self.since, self.until)
+                        block = next(blocks, None)
+                        if block:
+                            print(f"==> {log} <==")
+                            sys.stdout.flush()
+                            sys.stdout.buffer.write(block)
+                            sys.stdout.buffer.writelines(blocks)
+                            sys.stdout.buffer.flush()
+                            found = True
+                if found:
+                    print('\n')
+            elif skip is not None:
+                log = log_dir / 'current'
+                if log.is_file():
+                    with open_log(log) as f:
+                        print_lines((line.rstrip(b'\n') for line in islice(f, skip, None)), log)
+                    print('\n')
+            else:
+                chunks = tail_log(log_dir, count)
+                for log, lines in chunks:
+                    print_lines(lines, log)
+                if chunks:
                     print('\n')
 
+    def grep(self, log_dirs):
+        try:
+            re.compile(self.pattern.encode())
+        except re.error as e:
+            fail(1, f"Invalid pattern: {e}")
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from datetime import datetime
+        with ProcessPoolExecutor() as pool:
+            jobs = {}  # job: log file
+            for log_dir in log_dirs:
+                for log in range_files(log_dir, self.since, self.until):
+                    try:
+                        with open(log, 'rb') as f:
+                            compressed = f.read(6).startswith(COMPRESSED_MAGIC)
+                        size = os.stat(log).st_size
+                    except OSError:
+                        continue
+                    ranges = ((0, None),) if compressed else (
+                        (start, start + GREP_SPLIT) for start in range(0, size, GREP_SPLIT)
+                    )
+                    jobs.update(
+                        (pool.submit(
+                            grep_log, log_dir.name, log, self.pattern,
+                            start, end, self.since, self.until
+                        ), log)
+                        for start, end in ranges
+                    )
+            for job in as_completed(jobs):
+                try:
+                    matches = job.result()
+                except Exception as e:
+                    warn(f"{e}")
+                    continue
+                if self.output_format != 'text':
+                    for name, stamp, line in matches:
+                        self.emit({
+                            'name': name, 'file': str(jobs[job]), 'time': stamp,
+                            'text': line.decode(errors='replace')
+                        })
+                    continue
+                for name, stamp, line in matches:
+                    print(
+                        f"{name:<20}" | blue,
+                        datetime.fromtimestamp(stamp).isoformat(' ', 'milliseconds')
+                        if stamp else '-',
+                        line.decode(errors='replace')
+                    )
+
+    def follow_externally(self, logs):
+        try:
+            mtail = local.get('lnav', 'multitail')
+        except CommandNotFound:
+            cmds.tail[['-n', self.lines, '-F'] + logs].run_fg()
+        else:
+            mtail[logs].run_fg()
+
 
 @Essex.subcommand('sig')
 class EssexSignal(ColorApp):
@@ -558,11 +2507,12 @@ class EssexSignal(ColorApp):
         'stop': 'p', 'cont': 'c', 'winch': 'y'
     }
 
-    def main(self, signal: Set(*sigs), *svc_names):
+    def main(self, signal: Set(*sigs), *selectors):
         self.parent.fail_if_unsupervised()
         sig = self.sigs[signal.lower()]
-        for svc in self.parent.svc_map(svc_names or self.parent.svcs):
-            s6_svc[f'-{sig}', svc].run_fg()
+        for svc in self.parent.select(selectors):
+            with phase('sig', svc):
+                cmds.s6_svc[f'-{sig}', svc].run_fg()
 
 
 def columnize_comments(*line_pairs):
@@ -573,6 +2523,111 @@ def columnize_comments(*line_pairs):
     )
 
 
+def numeric_owner(as_user):
+    """USER[:GROUP] with any names as IDs, looked up in-process, as s6-setuidgid wants USER:GROUP numeric"""
+    if ':' not in as_user:
+        return as_user
+    import grp, pwd
+    user, group = as_user.split(':', 1)
+    if not user.isnumeric():
+        user = pwd.getpwnam(user).pw_uid
+    if not group.isnumeric():
+        group = grp.getgrnam(group).gr_gid
+    return f"{user}:{group}"
+
+
+def render_service(
+    svc_name, cmd, logs_dir, working_dir=None, as_user=None, finish=None,
+    rotate_at=4, prune_at=40, on_rotate=None, store=(), needs=(), human_time=False, enabled=None
+):
+    """A service's files as {path within the service: text, or None for no such file}; the down file is left alone if enabled is None"""
+    files = {}
+    shebang = ('#!/bin/execlineb -P', '')
+    err_to_out = ('fdmove -c 2 1', "Send stderr to stdout")
+    hash_run = (
+        'foreground { redirfd -w 1 run.md5 md5sum run }',
+        "Generate hashfile, to detect changes since launch"
+    )
+    set_user = (
+        f's6-setuidgid {as_user}', "Run as this user"
+    ) if as_user else None
+    working_dir = (
+        f'cd {working_dir}', "Enter working directory"
+    ) if working_dir else None
+    store_vars = []
+    for store_var in store:
+        var, store_cmd = store_var.split('=', 1)
+        store_vars.append((f'backtick -n {var} {{ {store_cmd} }} importas -u {var} {var}', "Store command output"))
+    files['run'] = columnize_comments(*filter(None, (
+        shebang, err_to_out, hash_run, set_user, working_dir, *store_vars, (cmd, "Do the thing")
+    )))
+    files['finish'] = columnize_comments(*filter(None, (
+        ('#!/bin/execlineb', ''), err_to_out, set_user, (finish, "Do the thing")
+    ))) if finish else None
+    receive = ('s6-log', "Receive process output")
+    timestamp = (
+        '  T', "Start each line with an ISO 8601 timestamp"
+    ) if human_time else (
+        '  t', "Start each line with a TAI64N timestamp"
+    )
+    rotate = (
+        f'  s{rotate_at * 1024 ** 2}',
+        "Archive log when it gets this big (bytes)"
+    )
+    prune = (
+        f'  S{prune_at * 1024 ** 2}',
+        "Purge oldest archived logs when the archive gets this big (bytes)"
+    )
+    process = (
+        f'!"{on_rotate}"',
+        "Processor (log --stdin--> processor --stdout--> archive)"
+    ) if on_rotate else None
+    logfile = (f'  {logs_dir / svc_name}', "Store logs here")
+    files['log/run'] = columnize_comments(*filter(None, (
+        shebang, hash_run, receive, timestamp, rotate, prune, process, logfile
+    )))
+    files['dependencies'] = ''.join(f"{need}\n" for need in needs) or None
+    if enabled is not None:
+        files['down'] = None if enabled else ''
+    return files
+
+
+def write_service(svc, files):
+    """Make svc's files match rendered ones, each replaced atomically, and return those changed"""
+    if not svc.exists():
+        # Build it aside, so s6-svscan can't find it half-made
+        building = svc.up() / f".{svc.name}.essex-new"
+        building.delete()
+        building.mkdir()
+        changed = write_service(building, files)
+        os.rename(building, svc)
+        return changed
+    changed = []
+    for name, text in files.items():
+        path, mode = svc / name, 0o644 if name in ('dependencies', 'down') else 0o755
+        try:
+            with open(path) as f:
+                current = f.read()
+            current_mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            current = current_mode = None
+        if text is None:
+            if current is not None:
+                path.delete()
+                changed.append(name)
+            continue
+        if current == text and current_mode == mode:
+            continue
+        path.up().mkdir()
+        tmp = path.up() / f".{path.name}.essex-new"
+        with open(tmp, 'w') as f:
+            f.write(text)
+            os.fchmod(f.fileno(), mode)
+        os.replace(tmp, path)
+        changed.append(name)
+    return changed
+
+
 @Essex.subcommand('new')
 class EssexNew(ColorApp):
     """Create a new service"""
@@ -644,6 +2699,16 @@ class EssexNew(ColorApp):
         list=True
     )
 
+    needs = SwitchAttr(
+        ['n', 'needs'],
+        argname='SVC_NAME',
+        help=(
+            "another service which must be started before, and stopped after, this one; "
+            "stored in the new service's dependencies file"
+        ),
+        list=True
+    )
+
     human_time = Flag(
         ['t', 'human-time'],
         help="Start each log line with an ISO 8601 timestamp, rather than TAI64N"
@@ -651,94 +2716,335 @@ class EssexNew(ColorApp):
 
     # TODO: use skabus-dyntee for socket-logging? maybe
     def main(self, svc_name, cmd):
-        self.svc = self.parent.svcs_dir / svc_name
-        if self.svc.exists():
-            fail(1, f"{self.svc} already exists!")
-        self.cmd = cmd
-        if self.as_user and ':' in self.as_user:
-            user, group = self.as_user.split(':', 1)
-            if not user.isnumeric():
-                user = uid('-u', user).strip()
-            if not group.isnumeric():
-                group = getent('group', group).split(':')[2]
-            self.as_user = f"{user}:{group}"
-        self.mk_runfile()
-        self.mk_logger()
-        if not self.enabled:
-            (self.svc / 'down').touch()
-
-    def mk_runfile(self):
-        self.svc.mkdir()
-        runfile = self.svc / 'run'
-        shebang = ('#!/bin/execlineb -P', '')
-        cmd = (self.cmd, "Do the thing")
-        err_to_out = ('fdmove -c 2 1', "Send stderr to stdout")
-        hash_run = (
-            'foreground { redirfd -w 1 run.md5 md5sum run }',
-            "Generate hashfile, to detect changes since launch"
-        )
-        set_user = (
-            f's6-setuidgid {self.as_user}', "Run as this user"
-        ) if self.as_user else None
-        working_dir = (
-            f'cd {self.working_dir}', "Enter working directory"
-        ) if self.working_dir else None
-        store_vars = []
-        for store_var in self.store:
-            var, store_cmd = store_var.split('=', 1)
-            store_vars.append((f'backtick -n {var} {{ {store_cmd} }} importas -u {var} {var}', "Store command output"))
-        runfile.write(columnize_comments(*filter(None, (
-            shebang, err_to_out, hash_run, set_user, working_dir, *store_vars, cmd
-        ))))
-        runfile.chmod(0o755)
-        if self.on_finish:
-            runfile = self.svc / 'finish'
-            shebang = ('#!/bin/execlineb', '')
-            cmd = (self.on_finish, "Do the thing")
-            runfile.write(columnize_comments(*filter(None, (
-                shebang, err_to_out, set_user, cmd
-            ))))
-            runfile.chmod(0o755)
-
-    def mk_logger(self):
-        logger = self.svc / 'log'
-        logger.mkdir()
-        runfile = logger / 'run'
-        shebang = ('#!/bin/execlineb -P', '')
-        hash_run = (
-            'foreground { redirfd -w 1 run.md5 md5sum run }',
-            "Generate hashfile, to detect changes since launch"
-        )
-        receive = ('s6-log', "Receive process output")
-        timestamp = (
-            '  T', "Start each line with an ISO 8601 timestamp"
-        ) if self.human_time else (
-            '  t', "Start each line with a TAI64N timestamp"
-        )
-        rotate = (
-            f'  s{self.rotate_at * 1024 ** 2}',
-            "Archive log when it gets this big (bytes)"
-        )
-        prune = (
-            f'  S{self.prune_at * 1024 ** 2}',
-            "Purge oldest archived logs when the archive gets this big (bytes)"
+        svc = self.parent.svcs_dir / svc_name
+        if svc.exists():
+            fail(1, f"{svc} already exists!")
+        try:
+            as_user = self.as_user and numeric_owner(self.as_user)
+        except KeyError as e:
+            fail(1, f"Unknown user or group in {self.as_user}: {e}")
+        write_service(svc, render_service(
+            svc_name, cmd, self.parent.logs_dir, self.working_dir, as_user, self.on_finish,
+            self.rotate_at, self.prune_at, self.on_rotate, self.store, self.needs,
+            self.human_time, self.enabled
+        ))
+
+
+MANIFEST_PARSERS = ('tomllib', 'tomli', 'toml')
+
+# Manifest keys are essex new's long switch names, plus cmd
+MANIFEST_KEYS = {
+    'cmd': (str,), 'working-dir': (str,), 'as-user': (str, int), 'finish': (str,),
+    'rotate-at': (int,), 'prune-at': (int,), 'on-rotate': (str,), 'store': (list, dict),
+    'needs': (list,), 'human-time': (bool,), 'enable': (bool,)
+}
+
+
+def load_manifest(path):
+    """A manifest's {service name: options}, with its defaults table applied"""
+    with open(path) as f:
+        text = f.read()
+    if path.suffix == '.json':
+        import json
+        manifest = json.loads(text)
+    else:
+        for module in MANIFEST_PARSERS:
+            with suppress(ImportError):
+                parser = import_module(module)
+                break
+        else:
+            raise ValueError(f"Reading TOML needs one of {', '.join(MANIFEST_PARSERS)}")
+        manifest = parser.loads(text)
+    if not isinstance(manifest, dict):
+        raise ValueError("it isn't a table")
+    defaults, services = manifest.get('defaults', {}), manifest.get('services', {})
+    for key, table in (('defaults', defaults), ('services', services)):
+        if not isinstance(table, dict):
+            raise ValueError(f"its {key} isn't a table")
+    return {
+        # a service that isn't a table is left as is, for manifest_problems to name
+        name: {**defaults, **options} if isinstance(options, dict) else options
+        for name, options in services.items()
+    }
+
+
+def store_entries(store):
+    """A manifest's store option as (var, cmd) pairs, from a table or a list of VAR=CMD"""
+    if isinstance(store, dict):
+        return list(store.items())
+    return [item.partition('=')[::2] if isinstance(item, str) else (item, None) for item in store]
+
+
+def manifest_problems(name, options):
+    if not name or name.startswith('.') or '/' in name:
+        yield "isn't a valid service name"
+    if not isinstance(options, dict):
+        yield "isn't a table"
+        return
+    if 'cmd' not in options:
+        yield "has no cmd"
+    for key, val in options.items():
+        types = MANIFEST_KEYS.get(key.replace('_', '-'))
+        if not types:
+            yield f"has unknown option {key}"
+        # bools are ints to isinstance, but true isn't a number of megabytes
+        elif not isinstance(val, types) or isinstance(val, bool) and bool not in types:
+            yield f"has {key} of the wrong type"
+        elif key == 'store' and not all(
+            isinstance(var, str) and isinstance(cmd, str) and var and cmd
+            for var, cmd in store_entries(val)
+        ):
+            yield "has store entries that aren't all VAR=CMD strings"
+        elif key == 'needs' and not all(isinstance(need, str) for need in val):
+            yield "has needs that aren't all service names"
+    for key, low, high in (('rotate-at', 1, 256), ('prune-at', 0, 1024)):
+        val = options.get(key, options.get(key.replace('-', '_')))
+        if isinstance(val, int) and not low <= val <= high:
+            yield f"has {key} outside {low}-{high}"
+
+
+@Essex.subcommand('apply')
+class EssexApply(ColorApp):
+    """Create or update the services described in a TOML (or JSON) manifest, rewriting only what's changed"""
+
+    def main(self, manifest: local.path):
+        try:
+            svcs = load_manifest(manifest)
+        except (OSError, ValueError) as e:
+            fail(1, f"Can't load {manifest}: {e}")
+        problems = [
+            f"{name} {problem}"
+            for name, options in svcs.items()
+            for problem in manifest_problems(name, options)
+        ]
+        if problems:
+            fail(1, '\n'.join(problems))
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        for name, options in svcs.items():
+            options = {key.replace('-', '_'): val for key, val in options.items()}
+            if 'store' in options:
+                options['store'] = [f"{var}={cmd}" for var, cmd in store_entries(options['store'])]
+            if 'working_dir' in options:  # relative to here, as for essex new
+                options['working_dir'] = local.path(options['working_dir'])
+            svc = self.parent.svcs_dir / name
+            existed = svc.exists()
+            # like essex new, a new service is disabled unless the manifest says otherwise
+            options['enabled'] = options.pop('enable', None if existed else False)
+            try:
+                if 'as_user' in options:
+                    options['as_user'] = numeric_owner(str(options['as_user']))
+                changed = write_service(
+                    svc, render_service(name, logs_dir=self.parent.logs_dir, **options)
+                )
+            except KeyError as e:
+                warn(f"{name}: unknown user or group {e}")
+                continue
+            except OSError as e:
+                warn(f"{name}: {e}")
+                continue
+            if not existed:
+                counts['created'] += 1
+                print(f"{name:<20} created" | green)
+            elif changed:
+                counts['updated'] += 1
+                print(f"{name:<20} updated {', '.join(changed)}" | yellow)
+            else:
+                counts['unchanged'] += 1
+        print(', '.join(f"{count} {what}" for what, count in counts.items()))
+        if len(svcs) > sum(counts.values()):
+            fail(1)
+
+
+# The subcommand classes --all-roots may run, by their names in ALL_ROOTS_SUBCOMMANDS
+ALL_ROOTS_APPS = {
+    EssexList: 'list', EssexLog: 'log', EssexOff: 'off', EssexStatus: 'status', EssexSync: 'sync'
+}
+
+
+def fork_essex(argv, svcs_dir, logs_dir):
+    """Run an essex command line in a forked child, returning its pid and the read ends of its stdout and stderr"""
+    out, err = os.pipe(), os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.close(out[1])
+        os.close(err[1])
+        return pid, out[0], err[0]
+    r = 1
+    try:
+        os.close(out[0])
+        os.close(err[0])
+        os.dup2(out[1], 1)
+        os.dup2(err[1], 2)
+        r = run_essex(argv, svcs_dir, logs_dir)
+    except KeyboardInterrupt:
+        r = 130
+    except Exception:
+        import traceback
+        warn(f"essex failed for {svcs_dir}:")
+        traceback.print_exc()
+    finally:
+        with suppress(Exception):
+            sys.stdout.flush()
+            sys.stderr.flush()
+        os._exit(r)
+
+
+def run_essex(argv, svcs_dir, logs_dir):
+    """Run an essex command line in this process, returning its exit code rather than exiting"""
+    try:
+        return Essex.run(
+            ['essex', '-d', str(svcs_dir), '-l', str(logs_dir), *argv], exit=False
+        )[1] or 0
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            warn(e.code)
+            return 1
+        return e.code or 0
+
+
+@Essex.subcommand('batch')
+class EssexBatch(ColorApp):
+    """Run many essex commands (one per line, from a file or stdin) in one process, stopping at the first failure"""
+
+    def main(self, commands_file=None):
+        import shlex
+        Essex.status_cache = Essex.status_cache or StatusCache()
+        lines = open(commands_file) if commands_file else sys.stdin
+        try:
+            for line in lines:
+                argv = shlex.split(line, comments=True)
+                if not argv:
+                    continue
+                if self.parent.enabled_only:
+                    argv.insert(0, '--enabled')
+                r = run_essex(argv, self.parent.svcs_dir, self.parent.logs_dir)
+                sys.stdout.flush()
+                if r:
+                    fail(r, f"Failed: {line.strip()}")
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+
+@Essex.subcommand('serve')
+class EssexServe(ColorApp):
+    """Keep running, serving essex commands over a Unix socket, with services' states kept warm"""
+
+    socket_path = SwitchAttr(
+        ['s', 'socket'],
+        local.path,
+        argname='SOCKET',
+        help="listen here; the default is SERVICES_DIRECTORY/.essex.sock"
+    )
+
+    def run_captured(self, argvs, cwd=None, color=False, logs_dir=None):
+        """Run essex command lines in turn, stopping at the first failure, and collect their output"""
+        from tempfile import TemporaryFile
+        from plumbum import colors
+        with self.lock, TemporaryFile() as out, TemporaryFile() as err:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Redirect the fds rather than sys.stdout, to catch subprocesses' output too
+            saved = os.dup(1), os.dup(2)
+            os.dup2(out.fileno(), 1)
+            os.dup2(err.fileno(), 2)
+            colors.use_color, r = 4 if color else 0, 0
+            try:
+                with suppress(OSError):
+                    os.chdir(cwd or self.cwd)
+                for argv in argvs:
+                    try:
+                        r = run_essex(argv, self.parent.svcs_dir, logs_dir or self.parent.logs_dir)
+                    except Exception as e:
+                        warn(f"{type(e).__name__}: {e}")
+                        r = 1
+                    if r:
+                        break
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                for fd, orig in zip((1, 2), saved):
+                    os.dup2(orig, fd)
+                    os.close(orig)
+                colors.use_color = self.color
+            out.seek(0)
+            err.seek(0)
+            return {
+                'code': r,
+                'stdout': out.read().decode(errors='replace'),
+                'stderr': err.read().decode(errors='replace')
+            }
+
+    def handle(self, line):
+        import json
+        try:
+            request = json.loads(line)
+            argvs = request['batch'] if 'batch' in request else [request['argv']]
+            if not all(isinstance(argv, list) for argv in argvs):
+                raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {'code': 2, 'stdout': '', 'stderr': f"Bad request: {line[:80]!r}\n"}
+        return self.run_captured(
+            argvs, request.get('cwd'), request.get('color', False), request.get('logs_dir')
         )
-        process = (
-            f'!"{self.on_rotate}"',
-            "Processor (log --stdin--> processor --stdout--> archive)"
-        ) if self.on_rotate else None
-        logfile = (f'  {self.parent.logs_dir / self.svc.name}', "Store logs here")
-        runfile.write(columnize_comments(*filter(None, (
-            shebang, hash_run, receive, timestamp, rotate, prune, process, logfile
-        ))))
-        runfile.chmod(0o755)
+
+    def main(self):
+        import json, socket, socketserver, threading
+        from plumbum import colors
+        self.parent.fail_if_serving('essex serve')
+        sock = self.socket_path or self.parent.svcs_dir / '.essex.sock'
+        with suppress(OSError), socket.socket(socket.AF_UNIX) as probe:
+            probe.connect(str(sock))
+            fail(1, f"Already serving on {sock}")
+        with suppress(FileNotFoundError):
+            sock.delete()
+        Essex.status_cache, Essex.serving = StatusCache(), True
+        self.lock, self.cwd, self.color = threading.Lock(), os.getcwd(), colors.use_color
+        app = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    reply = app.handle(line.decode(errors='replace'))
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        umask = os.umask(0o177)  # only our own user may run commands as us
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(sock), Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"Serving essex commands on {sock}" | green)
+        sys.stdout.flush()
+        try:
+            with suppress(KeyboardInterrupt):
+                server.serve_forever()
+        finally:
+            server.server_close()
+            with suppress(OSError):
+                sock.delete()
+
+
+def raise_fd_limit():
+    """Raise the soft limit on open files to the hard limit, for watching many services at once"""
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        with suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
 
 def main():
+    raise_fd_limit()
     for app in (
-        EssexCat, EssexDisable, EssexEnable, EssexList, EssexLog, EssexNew,
-        EssexOff, EssexOn, EssexPid, EssexPrint, EssexReload, EssexSignal,
-        EssexStart, EssexStatus, EssexStop, EssexSync, EssexTree, EssexUpgrade
+        EssexApply, EssexBatch, EssexCat, EssexDisable, EssexEnable, EssexList, EssexLog,
+        EssexMetrics, EssexNew, EssexOff, EssexOn, EssexPid, EssexPrint, EssexReload,
+        EssexServe, EssexSignal, EssexStart, EssexStatus, EssexStop, EssexSync, EssexTop,
+        EssexTree, EssexUpgrade
     ):
         app.unbind_switches('help-all', 'v', 'version')
     Essex()
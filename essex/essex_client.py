@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import io, json, os, shlex, socket, sys
+from functools import partial
+
+# No plumbum here, so that commands forwarded to a running `essex serve`
+# skip essex's own startup entirely; anything else is handed to essex.main
+
+
+# Subcommands which essex serve can run on our behalf, as they don't need our terminal,
+# nor start anything long-lived (like on's s6-svscan), which would get the server's environment
+served = (
+    'disable', 'enable', 'list', 'new', 'off', 'pid', 'reload',
+    'sig', 'start', 'status', 'stop', 'sync', 'upgrade'
+)
+global_opts = {
+    '-d': 'svcs_dir', '--directory': 'svcs_dir',
+    '-l': 'logs_dir', '--logs-directory': 'logs_dir'
+}
+global_flags = ('-E', '--enabled')
+# Seconds to wait for essex serve to accept us, before running locally instead,
+# and to reply, before giving up on it (as it may have acted already); 0 waits forever
+connect_timeout = 2
+reply_timeout = float(os.environ.get('ESSEX_SERVE_TIMEOUT', 120))
+
+
+def split_argv(argv):
+    """The global switches' values, global flags, and remaining args, or None if they're not understood"""
+    switches, flags, idx = {}, [], 0
+    while idx < len(argv) and argv[idx].startswith('-'):
+        if argv[idx] in global_flags:
+            flags.append(argv[idx])
+            idx += 1
+            continue
+        opt, eq, val = argv[idx].partition('=')
+        if opt not in global_opts:
+            return None
+        if not eq:
+            idx += 1
+            if idx == len(argv):
+                return None
+            val = argv[idx]
+        switches[global_opts[opt]] = os.path.abspath(os.path.expanduser(val))
+        idx += 1
+    return switches, flags, argv[idx:]
+
+
+def get_svcs_dir(defaults=('./svcs', '~/svcs', '/var/svcs', '/svcs')):
+    try:
+        svcs_paths = os.environ['SERVICES_PATHS'].split(':')
+    except KeyError:
+        svcs_paths = defaults
+    for folder in map(os.path.expanduser, svcs_paths):
+        if os.path.isdir(folder):
+            return os.path.abspath(folder)
+    return os.path.abspath(os.path.expanduser(svcs_paths[0]))
+
+
+def servable(args):
+    if not args or args[0] not in served:
+        return False
+    if args[0] == 'status':
+        return not any(
+            arg == '--watch' or (arg.startswith('-') and not arg.startswith('--') and 'w' in arg)
+            for arg in args[1:]
+        )
+    return True
+
+
+def batch_lines(flags, args):
+    """A batch's command lines, with any global flags, or None if they can't all be served"""
+    if len(args) > 2 or any(arg.startswith('-') for arg in args[1:]):
+        return None
+    if len(args) == 2:
+        try:
+            with open(args[1]) as lines:
+                text = lines.read()
+        except OSError:  # for essex to complain about
+            return None
+    else:
+        # Keep what we've read, in case essex has to read it again after all
+        text = sys.stdin.read()
+        sys.stdin = io.StringIO(text)
+    argvs = [argv for argv in map(partial(shlex.split, comments=True), text.splitlines()) if argv]
+    return [flags + argv for argv in argvs] if all(map(servable, argvs)) else None
+
+
+def use_color():
+    if 'NO_COLOR' in os.environ:
+        return False
+    if os.environ.get('FORCE_COLOR', '') in ('0', '1', '2', '3', '4'):
+        return os.environ['FORCE_COLOR'] != '0'
+    return sys.stdout.isatty()
+
+
+def forward(sock_path, request):
+    """Send request to essex serve and return its reply, or None if it isn't listening"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect(sock_path)
+        except OSError:  # including socket.timeout
+            return None
+        sock.settimeout(reply_timeout or None)
+        try:
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as replies:
+                reply = replies.readline()
+        except socket.timeout:
+            sys.exit(
+                f"essex serve didn't reply within {reply_timeout:g} seconds; "
+                "set ESSEX_SERVE_TIMEOUT to wait longer, or 0 to wait forever"
+            )
+    if not reply:
+        sys.exit("essex serve hung up without replying")
+    return json.loads(reply)
+
+
+def run_locally():
+    try:
+        from essex.essex import main as essex_main
+    except ImportError:  # run from inside the essex folder
+        from essex import main as essex_main
+    essex_main()
+
+
+def main():
+    parsed = split_argv(sys.argv[1:])
+    if not parsed or not parsed[2]:
+        return run_locally()
+    switches, flags, args = parsed
+    if args[0] == 'batch':
+        argvs = batch_lines(flags, args)
+        if argvs is None:
+            return run_locally()
+        request = {'batch': argvs}
+    elif servable(args):
+        request = {'argv': flags + args}
+    else:
+        return run_locally()
+    request.update(cwd=os.getcwd(), color=use_color())
+    if 'logs_dir' in switches:
+        request['logs_dir'] = switches['logs_dir']
+    svcs_dir = switches.get('svcs_dir') or get_svcs_dir()
+    reply = forward(os.path.join(svcs_dir, '.essex.sock'), request)
+    if reply is None:
+        return run_locally()
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    sys.exit(reply['code'])
+
+
+if __name__ == '__main__':
+    main()
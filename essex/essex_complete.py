@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 
-import shlex
+import os, shlex
 from sys import argv
 from itertools import count
 from collections import defaultdict
 
-from plumbum import local
+# No plumbum here, as this runs on every TAB press
 
 
 subcommands = (
-    'cat', 'disable', 'enable', 'list', 'log', 'new', 'off', 'on', 'pid',
-    'print', 'reload', 'sig', 'start', 'status', 'stop', 'sync', 'tree', 'upgrade'
+    'apply', 'batch', 'cat', 'disable', 'enable', 'list', 'log', 'metrics', 'new', 'off', 'on',
+    'pid', 'print', 'reload', 'serve', 'sig', 'start', 'status', 'stop', 'sync', 'top', 'tree',
+    'upgrade'
 )
 signals = (
     'alrm', 'abrt', 'quit', 'hup', 'kill', 'term', 'int',
@@ -20,66 +21,131 @@ signals = (
 # Declare switches, which take arguments
 stop_cmds = ('off', 'reload', 'stop', 'sync', 'upgrade')
 opts = defaultdict(tuple, {
-    sc: ('-f', '--fail-after', '-k', '--kill-after') for sc in stop_cmds
+    sc: ('-f', '--fail-after', '-k', '--kill-after', '-j', '--jobs') for sc in stop_cmds
 })
 opts.update({
-    'essex': ('-d', '--directory', '-l', '--logs-directory'),
-    'log': ('-n', '--lines'),
+    'essex': ('-d', '--directory', '-l', '--logs-directory', '--trace'),
+    'list': ('--format',),
+    'log': ('-n', '--lines', '-s', '--since', '-u', '--until', '-g', '--grep', '--format'),
+    'metrics': ('-o', '--output', '-p', '--port', '-b', '--bind', '-i', '--interval'),
+    'pid': ('--format',),
+    'serve': ('-s', '--socket'),
+    'start': ('-j', '--jobs', '-t', '--timeout'),
+    'status': ('--format',),
+    'sync': (*opts['sync'], '-t', '--timeout', '--deadline', '--format'),
+    'top': ('-i', '--interval', '-n', '--iterations'),
     'new': (
         '-d', '--working-dir', '-f', '--finish', '-o', '--on-rotate',
-        '-p', '--prune-at', '-r', '--rotate-at', '-u', '--as-user', '-s', '--store'
+        '-p', '--prune-at', '-r', '--rotate-at', '-u', '--as-user', '-s', '--store',
+        '-n', '--needs'
     )
 })
+for sc in ('reload', 'upgrade'):
+    opts[sc] += ('-t', '--timeout', '-b', '--batch', '-m', '--max-unavailable')
 
 # Declare flags, which take no arguments. All svcs have -h, --help
 hlp = ('-h', '--help')
 flags = defaultdict(lambda: hlp)
-flags['cat'] += ('-n', '--no-color', '-r', '--run-only', '-e', '--enabled')
+flags['essex'] += ('-A', '--all-roots', '-E', '--enabled')
+flags['cat'] += (
+    '-n', '--no-color', '-r', '--run-only', '-e', '--enabled',
+    '-x', '--external-highlighter', '-P', '--no-pager'
+)
 flags['log'] += ('-f', '--follow', '-d', '--debug')
 flags['new'] += ('-e', '--enable', '-t', '--human-time')
 flags['list'] += ('-e', '--enabled')
-flags['print'] += ('-n', '--no-color', '-r', '--run-only', '-e', '--enabled')
-flags['status'] += ('-e', '--enabled')
+flags['print'] += (
+    '-n', '--no-color', '-r', '--run-only', '-e', '--enabled',
+    '-x', '--external-highlighter', '-P', '--no-pager'
+)
+flags['status'] += ('-e', '--enabled', '-w', '--watch')
+flags['sync'] += ('-n', '--dry-run')
 flags['tree'] += ('-q', '--quiet')
 
 
 def get_subcmd(words):
+    """The subcommand being completed, and its index in words"""
     subcmd = 'essex'
     for idx in count(1):
         if idx == len(words):
-            return subcmd
+            return subcmd, idx
         if all((
             words[idx] not in (*opts['essex'], *flags['essex']),
             words[idx - 1] not in opts['essex'],
             words[idx] in subcommands
         )):
-            return words[idx]
+            return words[idx], idx
 
 
-def get_svcs_dir(words, defaults=('./svcs', '~/svcs', '/var/svcs', '/svcs')):
+def get_svcs_dirs(words, defaults=('./svcs', '~/svcs', '/var/svcs', '/svcs')):
+    """The services folder being completed for, or with -A, every existing one"""
     for idx in (1, 3):
-        if idx < len(words) and words[idx] in ('-d', '--directory'):
-            return local.path(words[idx + 1])
+        if idx < len(words) - 1 and words[idx] in ('-d', '--directory'):
+            return [os.path.abspath(os.path.expanduser(words[idx + 1]))]
     try:
-        svcs_paths = local.env['SERVICES_PATHS'].split(':')
+        svcs_paths = os.environ['SERVICES_PATHS'].split(':')
     except KeyError:
         svcs_paths = defaults
-    for folder in map(local.path, svcs_paths):
-        if folder.is_dir():
-            return folder
-    return local.path(svcs_paths[0])
+    folders = [
+        os.path.abspath(folder)
+        for folder in map(os.path.expanduser, svcs_paths) if os.path.isdir(folder)
+    ]
+    if not folders:
+        return [os.path.abspath(os.path.expanduser(svcs_paths[0]))]
+    return folders if {'-A', '--all-roots'} & set(words[:get_subcmd(words)[1]]) else folders[:1]
 
 
 def get_svcs(words):
-    return tuple(f for f in get_svcs_dir(words) if 'run' in f)
+    """Service names, from all folders being completed for"""
+    return sorted({svc for svcs_dir in get_svcs_dirs(words) for svc in get_dir_svcs(svcs_dir)})
+
+
+def get_dir_svcs(svcs_dir):
+    """A folder's service names, from a cache which is rebuilt whenever its mtime changes"""
+    try:
+        mtime = str(os.stat(svcs_dir).st_mtime_ns)
+    except OSError:
+        return ()
+    cache = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'essex', 'svcs' + svcs_dir.replace('%', '%%').replace('/', '%')
+    )
+    try:
+        with open(cache) as f:
+            cached_mtime, *svcs = f.read().splitlines()
+        if cached_mtime == mtime:
+            return svcs
+    except (OSError, ValueError):
+        pass
+    with os.scandir(svcs_dir) as entries:
+        svcs = sorted(
+            entry.name for entry in entries
+            if os.path.exists(os.path.join(entry.path, 'run'))
+        )
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(f"{cache}.{os.getpid()}", 'w') as f:
+            f.write('\n'.join((mtime, *svcs)))
+        os.replace(f"{cache}.{os.getpid()}", cache)
+    except OSError:
+        pass
+    return svcs
+
+
+def count_positionals(subcmd, args):
+    return sum(
+        not arg.startswith('-') and (idx == 0 or args[idx - 1] not in opts[subcmd])
+        for idx, arg in enumerate(args)
+    )
 
 
 def main():
     cmd, partial_word, prev_word = argv[1:]
-    line = local.env['COMP_LINE']
+    line = os.environ['COMP_LINE']
     suggestions = []
     words = shlex.split(line)
-    subcmd = get_subcmd(words)
+    subcmd, subcmd_idx = get_subcmd(words)
+    args = words[subcmd_idx + 1:len(words) - bool(partial_word)]
     suggestions.extend(
         opt for opt in (*opts[subcmd], *flags[subcmd])
         if opt.startswith(partial_word)
@@ -91,21 +157,24 @@ def main():
             sc for sc in subcommands
             if sc.startswith(partial_word)
         )
-    elif subcmd == 'sig' and prev_word == 'sig':
+    elif subcmd == 'sig' and not count_positionals(subcmd, args):
         suggestions.extend(
             sig for sig in signals
             if sig.startswith(partial_word)
         )
-    elif subcmd not in ('list', 'new', 'off', 'on', 'tree'):
+    elif subcmd not in ('apply', 'batch', 'list', 'metrics', 'new', 'off', 'on', 'serve', 'tree'):
         suggestions.extend(
-            svc.name for svc in get_svcs(words)
-            if svc.name.startswith(partial_word)
+            svc for svc in get_svcs(words)
+            if svc.startswith(partial_word)
         )
-    if subcmd == 'new' and prev_word in ('-u', '--as-user'):
+    if prev_word == '--format':
         suggestions.extend(
-            line.split(':')[0]
-            for line in local.path('/etc/passwd').read().splitlines()
+            fmt for fmt in ('text', 'json', 'ndjson')
+            if fmt.startswith(partial_word)
         )
+    if subcmd == 'new' and prev_word in ('-u', '--as-user'):
+        with open('/etc/passwd') as passwd:
+            suggestions.extend(line.split(':')[0] for line in passwd)
     print('\n'.join(suggestions))
 
 